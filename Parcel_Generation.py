@@ -13,10 +13,9 @@ Created on Wed Oct 27 08:56:07 2021
 
 
 
-from __functions__ import read_mtx, read_shape, create_geojson, get_traveltime, get_distance
+from __functions__ import read_mtx, open_mtx, intrazonal_values, skim_columns, skim_pairs, read_shape, read_points, ZoneIndex, InputCache, create_geojson, write_columnar, StageProfiler, get_traveltime, get_distance
 import pandas as pd
 import numpy as np
-import networkx as nx
 from itertools import islice, tee
 import math
 import sys, os
@@ -24,6 +23,11 @@ import time
 import ast
 import datetime as dt
 import json
+import gzip, bz2, lzma
+from functools import cached_property
+from multiprocessing import shared_memory
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 class HiddenPrints: #
     def __enter__(self):
@@ -42,6 +46,34 @@ cwd = os.getcwd().replace(os.sep, '/')
 datapath = cwd.replace('Code', '')
 
 #%% Define all variables
+def read_params(params_file, varDict):
+    '''
+    Read the parameters in params_file (lines of: key = value ; dtype) into varDict
+    '''
+    for line in params_file:
+        if len(line.split('=')) > 1:
+            key, value = line.split('=')
+            if len(value.split(';')) > 1:
+                value, dtype = value.split(';')
+                if len(dtype.split('#')) > 1: dtype, comment = dtype.split('#')
+                # Allow for spacebars around keys, values and dtypes
+                while key[0] == ' ' or key[0] == '\t': key = key[1:]
+                while key[-1] == ' ' or key[-1] == '\t': key = key[0:-1]
+                while value[0] == ' ' or value[0] == '\t': value = value[1:]
+                while value[-1] == ' ' or value[-1] == '\t': value = value[0:-1]
+                while dtype[0] == ' ' or dtype[0] == '\t': dtype = dtype[1:]
+                while dtype[-1] == ' ' or dtype[-1] == '\t': dtype = dtype[0:-1]
+                dtype = dtype.replace('\n',"")
+                # print(key, value, dtype)
+                if dtype == 'string': varDict[key] = str(value)
+                elif dtype == 'list': varDict[key] = ast.literal_eval(value)
+                elif dtype == 'int': varDict[key] = int(value)               
+                elif dtype == 'float': varDict[key] = float(value)               
+                elif dtype == 'bool': varDict[key] = eval(value)               
+                elif dtype == 'variable': varDict[key] = globals()[value]
+                elif dtype == 'eval': varDict[key] = eval(value)
+
+
 def generate_args(method):
     varDict = {}
    
@@ -85,30 +117,7 @@ def generate_args(method):
 
             
             
-        for line in params_file:
-            if len(line.split('=')) > 1:
-                key, value = line.split('=')
-                if len(value.split(';')) > 1:
-                    value, dtype = value.split(';')
-                    if len(dtype.split('#')) > 1: dtype, comment = dtype.split('#')
-                    # Allow for spacebars around keys, values and dtypes
-                    while key[0] == ' ' or key[0] == '\t': key = key[1:]
-                    while key[-1] == ' ' or key[-1] == '\t': key = key[0:-1]
-                    while value[0] == ' ' or value[0] == '\t': value = value[1:]
-                    while value[-1] == ' ' or value[-1] == '\t': value = value[0:-1]
-                    while dtype[0] == ' ' or dtype[0] == '\t': dtype = dtype[1:]
-                    while dtype[-1] == ' ' or dtype[-1] == '\t': dtype = dtype[0:-1]
-                    dtype = dtype.replace('\n',"")
-                    # print(key, value, dtype)
-                    if dtype == 'string': varDict[key] = str(value)
-                    elif dtype == 'list': varDict[key] = ast.literal_eval(value)
-                    elif dtype == 'int': varDict[key] = int(value)               
-                    elif dtype == 'float': varDict[key] = float(value)               
-                    elif dtype == 'bool': varDict[key] = eval(value)               
-                    elif dtype == 'variable': varDict[key] = globals()[value]
-                    elif dtype == 'eval': varDict[key] = eval(value)
-
-
+        read_params(params_file, varDict)
             
             
     elif method == 'from_code':
@@ -157,13 +166,6 @@ def generate_args(method):
     args = ['', varDict]
     return args, varDict
 
-method = 'from_file' #either from_file or from_code
-
-
-args, varDict = generate_args(method)
-
-TESTRUN = False # True to fasten further code TEST (runs with less parcels)
-TestRunLen = 100
 
 
 
@@ -187,52 +189,612 @@ Comienzo = dt.datetime.now()
 
 
 
-zones = read_shape(varDict['ZONES'])
-zones.index = zones['AREANR']
-nZones = len(zones)
+class ModelInputs:
+    '''
+    The input data of the model, read lazily from the paths in varDict.
+    Each input is read at most once, the first time it is needed. If
+    varDict contains a CACHEFOLDER, the inputs derived from the input files
+    are also cached on disk (see InputCache) and reused by later runs.
+    '''
+    
+    # The varDict keys of the input files each input depends on
+    inputKeys = {
+        'zones':                  ['ZONES'],
+        'supCoordinates':         ['ExternalZones'],
+        'zoneIndex':              ['ZONES', 'ExternalZones'],
+        'segs':                   ['SEGS'],
+        'parcelNodes':            ['PARCELNODES', 'ZONES', 'ExternalZones'],
+        'cepShares':              ['CEP_SHARES'],
+        'cepList':                ['PARCELNODES', 'ZONES', 'ExternalZones'],
+        'cepNodeDict':            ['PARCELNODES', 'ZONES', 'ExternalZones'],
+        'skimTravTime':           ['SKIMTIME'],
+        'skimDistance':           ['SKIMDISTANCE'],
+        'parcelSkim':             ['SKIMTIME', 'PARCELNODES', 'ZONES', 'ExternalZones'],
+        'depotChoice':            ['SKIMTIME', 'PARCELNODES', 'ZONES', 'ExternalZones'],
+        'studySkimNrs':           ['ZONES', 'ExternalZones', 'Gemeenten_studyarea'],
+        'studyParcelSkim':        ['SKIMTIME', 'PARCELNODES', 'ZONES', 'ExternalZones', 'Gemeenten_studyarea'],
+        'studyDepotChoice':       ['SKIMTIME', 'PARCELNODES', 'ZONES', 'ExternalZones', 'Gemeenten_studyarea'],
+        'depotCandidates':        ['SKIMTIME', 'PARCELNODES', 'ZONES', 'ExternalZones', 'DEPOT_TOPK'],
+        'studyDepotCandidates':   ['SKIMTIME', 'PARCELNODES', 'ZONES', 'ExternalZones', 'Gemeenten_studyarea', 'DEPOT_TOPK']}
+    
+    def __init__(self, varDict):
+        self.varDict = varDict
+        if varDict.get('CACHEFOLDER'):
+            self.cache = InputCache(varDict['CACHEFOLDER'], maxSize=varDict.get('CACHE_MAXSIZE', 2048) * 1024**2)
+        else:
+            self.cache = None
+    
+    
+    def _cached(self, name, keys, build):
+        '''
+        Return build(), through the disk cache if there is one. keys are the
+        varDict keys of the input files the result is derived from.
+        '''
+        if self.cache is None:
+            return build()
+        paths = []
+        for key in keys:
+            path = self.varDict[key]
+            paths.append(path)
+            if path.lower().endswith('.shp'):
+                paths.append(path[:-4] + ('.dbf' if path.endswith('.shp') else '.DBF'))
+        return self.cache.get(name, paths, build)
+    
+    
+    def with_params(self, varDict):
+        '''
+        The inputs for another varDict (e.g. of another scenario), reusing the
+        inputs already read that do not depend on input files that changed
+        '''
+        inputs = ModelInputs(varDict)
+        for name, keys in self.inputKeys.items():
+            if name in self.__dict__ and all(varDict.get(key) == self.varDict.get(key) for key in keys):
+                inputs.__dict__[name] = self.__dict__[name]
+        return inputs
+    
+    
+    def adopt(self, inputs):
+        '''
+        Take over the inputs that inputs (e.g. made by with_params) has read and
+        self has not, as far as they derive from the same input files
+        '''
+        for name, keys in self.inputKeys.items():
+            if name in inputs.__dict__ and name not in self.__dict__ and \
+               all(inputs.varDict.get(key) == self.varDict.get(key) for key in keys):
+                self.__dict__[name] = inputs.__dict__[name]
+        return self
+    
+    
+    def preload(self):
+        '''
+        Read the inputs a model run needs now instead of on first use
+        '''
+        for name in ['zones', 'zoneIndex', 'segs', 'parcelNodes', 'cepShares', 'cepNodeDict', 'depotChoice']:
+            getattr(self, name)
+        return self
+    
+    
+    @cached_property
+    def zones(self):
+        def read():
+            zones = read_shape(self.varDict['ZONES'])
+            zones = pd.DataFrame(zones).sort_values('AREANR')
+            zones.index = zones['AREANR']
+            return zones
+        return self._cached('zones', ['ZONES'], read)
+    
+    @cached_property
+    def supCoordinates(self):
+        def read():
+            supCoordinates = pd.read_csv(self.varDict['ExternalZones'], sep=',')
+            supCoordinates.index = supCoordinates['AREANR']
+            return supCoordinates
+        return self._cached('supCoordinates', ['ExternalZones'], read)
+    
+    @cached_property
+    def zoneIndex(self):
+        ''' Zone numbers, skim numbers and coordinates of the internal and external zones '''
+        return ZoneIndex.from_zones(self.zones, self.supCoordinates)
+    
+    @cached_property
+    def segs(self):
+        def read():
+            segs       = pd.read_csv(self.varDict['SEGS'])
+            segs.index = segs['zone']
+            return segs
+        return self._cached('segs', ['SEGS'], read)
+    
+    @cached_property
+    def parcelNodes(self):
+        def read():
+            parcelNodes = read_shape(self.varDict['PARCELNODES'])
+            parcelNodes['X'], parcelNodes['Y'] = read_points(self.varDict['PARCELNODES'])
+            parcelNodes.index   = parcelNodes['id'].astype(int)
+            parcelNodes         = parcelNodes.sort_index()
+            parcelNodes['SKIMNR'] = self.zoneIndex.skim_numbers(parcelNodes['AREANR'])
+            return parcelNodes
+        return self._cached('parcelNodes', ['PARCELNODES', 'ZONES', 'ExternalZones'], read)
+    
+    @cached_property
+    def cepShares(self):
+        def read():
+            return pd.read_csv(self.varDict['CEP_SHARES'], index_col=0)
+        return self._cached('cepShares', ['CEP_SHARES'], read)
+    
+    @cached_property
+    def cepList(self):
+        return np.unique(self.parcelNodes['CEP'])
+    
+    @cached_property
+    def cepNodeDict(self):
+        ''' CEP --> positions of its depots in parcelNodes '''
+        def build():
+            return {cep: np.where(self.parcelNodes['CEP']==str(cep))[0] for cep in self.cepList}
+        return self._cached('cepNodeDict', ['PARCELNODES'], build)
+    
+    @cached_property
+    def skimTravTime(self):
+        return open_mtx(self.varDict['SKIMTIME'])
+    
+    @cached_property
+    def skimDistance(self):
+        return open_mtx(self.varDict['SKIMDISTANCE'])
+    
+    @cached_property
+    def parcelSkim(self):
+        ''' Travel times [h] from each parcel node (columns) to all skim zones (rows) '''
+        def build():
+            return skim_columns(self.skimTravTime, self.parcelNodes['SKIMNR'], factor=1/3600)
+        return self._cached('parcelSkim', ['SKIMTIME', 'PARCELNODES', 'ZONES', 'ExternalZones'], build)
+    
+    @cached_property
+    def depotChoice(self):
+        ''' Position in parcelNodes of the nearest depot per skim zone (rows) and courier (columns) '''
+        def build():
+            return choose_depots(self.parcelSkim, self.cepList, self.cepNodeDict)
+        return self._cached('depotChoice', ['SKIMTIME', 'PARCELNODES', 'ZONES', 'ExternalZones'], build)
+    
+    @cached_property
+    def studySkimNrs(self):
+        ''' Skim numbers of the zones in the study area (Gemeenten_studyarea), in the order of zones '''
+        zones = self.zones
+        return self.zoneIndex.skim_numbers(zones['AREANR'][zones['GEMEENTEN'].isin(self.varDict['Gemeenten_studyarea'])])
+    
+    @cached_property
+    def studyParcelSkim(self):
+        '''
+        Travel times [h] from each parcel node (columns) to the zones of the study
+        area (rows, see studySkimNrs), read from the skim without the other zones
+        '''
+        return skim_columns(self.skimTravTime, self.parcelNodes['SKIMNR'], factor=1/3600, dests=self.studySkimNrs)
+    
+    @cached_property
+    def studyDepotChoice(self):
+        ''' Position in parcelNodes of the nearest depot per zone of the study area (rows) and courier (columns) '''
+        return choose_depots(self.studyParcelSkim, self.cepList, self.cepNodeDict)
+    
+    @cached_property
+    def depotCandidates(self):
+        '''
+        The DEPOT_TOPK (default 5) nearest depots per skim zone and courier,
+        with their travel times (see depot_candidates)
+        '''
+        k = self.varDict.get('DEPOT_TOPK', 5)
+        def build():
+            depots, times = depot_candidates(self.parcelSkim, self.cepList, self.cepNodeDict, k)
+            return {'depots': depots, 'times': times}
+        candidates = self._cached(f'depotCandidates{k}', ['SKIMTIME', 'PARCELNODES', 'ZONES', 'ExternalZones'], build)
+        return candidates['depots'], candidates['times']
+    
+    @cached_property
+    def studyDepotCandidates(self):
+        ''' The nearest depots per zone of the study area and courier, as depotCandidates '''
+        return depot_candidates(self.studyParcelSkim, self.cepList, self.cepNodeDict, self.varDict.get('DEPOT_TOPK', 5))
+
+
+def choose_depots(parcelSkim, cepList, cepNodeDict):
+    '''
+    Select for each zone (row of parcelSkim) and each courier the depot with the
+    lowest travel time. Returns the positions in parcelNodes (nZones x nCEP).
+    '''
+    depotChoice = np.zeros((parcelSkim.shape[0], len(cepList)), dtype=int)
+    for c, cep in enumerate(cepList):
+        cepNodes = cepNodeDict[cep]
+        depotChoice[:,c] = cepNodes[parcelSkim[:,cepNodes].argmin(axis=1)]
+    return depotChoice
+
+
+def depot_candidates(parcelSkim, cepList, cepNodeDict, k=5, chunkSize=4096):
+    '''
+    Select for each zone (row of parcelSkim) and each courier its k nearest
+    depots, nearest first (ties in the order of parcelNodes, so the first
+    candidate is the depot of choose_depots). Returns the positions in
+    parcelNodes and the travel times (both nZones x nCEP x k), padded with -1
+    and inf for couriers with fewer than k depots.
+    '''
+    nZones = parcelSkim.shape[0]
+    depots = np.full((nZones, len(cepList), k), -1, dtype=int)
+    times  = np.full((nZones, len(cepList), k), np.inf, dtype=np.float32)
+    for c, cep in enumerate(cepList):
+        cepNodes = cepNodeDict[cep]
+        kCep     = min(k, len(cepNodes))
+        for start in range(0, nZones, chunkSize):
+            cepTimes = np.asarray(parcelSkim[start:start+chunkSize][:, cepNodes])
+            nearest  = np.argsort(cepTimes, axis=1, kind='stable')[:, :kCep]
+            depots[start:start+chunkSize, c, :kCep] = cepNodes[nearest]
+            times[start:start+chunkSize, c, :kCep]  = np.take_along_axis(cepTimes, nearest, axis=1)
+    return depots, times
+
+
+def assign_depots_capacitated(destZones, nParcelsCep, candidates, candidateTimes, capacity, depotZones, cepList):
+    '''
+    Assign the parcels of each destination zone and courier to its candidate
+    depots (see depot_candidates) within the depot capacities (parcels per
+    depot), greedy with regret: the zone and courier pairs with the largest
+    extra travel time to their second candidate are assigned first, each to
+    its nearest candidates that have capacity left. Parcels that fit in none of
+    the candidates go to the nearest one, over its capacity.
+    Returns the parcel counts (as build_parcel_counts, with a row per depot when
+    the parcels of a zone and courier are split) and the number of parcels
+    over capacity per depot.
+    '''
+    destZones   = np.asarray(destZones, dtype=int)
+    nParcelsCep = np.asarray(nParcelsCep, dtype=int)
+    nCEP        = len(cepList)
+    k           = candidates.shape[2]
+    
+    # Zone and courier pairs with parcels, largest regret first
+    items  = np.where(nParcelsCep.ravel() > 0)[0]
+    zoneNr, cepNr = np.divmod(items, nCEP)
+    regret = (candidateTimes[zoneNr, cepNr, 1] - candidateTimes[zoneNr, cepNr, 0]) if k > 1 else np.full(len(items), np.inf)
+    order  = np.argsort(-regret, kind='stable')
+    
+    remaining = np.asarray(capacity, dtype=float).copy()
+    overflow  = np.zeros(len(remaining), dtype=int)
+    rowItem, rowRank, rowParcels = [], [], []
+    for i in order:
+        z, c    = zoneNr[i], cepNr[i]
+        parcels = nParcelsCep[z, c]
+        for rank in range(k):
+            depot = candidates[z, c, rank]
+            if depot < 0 or parcels == 0:
+                break
+            take = int(min(parcels, max(remaining[depot], 0)))
+            if take > 0:
+                rowItem.append(i), rowRank.append(rank), rowParcels.append(take)
+                remaining[depot] -= take
+                parcels -= take
+        if parcels > 0:
+            depot = candidates[z, c, 0]
+            rowItem.append(i), rowRank.append(0), rowParcels.append(parcels)
+            remaining[depot] -= parcels
+            overflow[depot]  += parcels
+    
+    # One row per zone, courier and depot, zone after zone, courier after courier, nearest depot first
+    # (typed explicitly, so that the columns stay integer when no parcels were assigned)
+    rows = pd.DataFrame({'item':    np.asarray(rowItem,    dtype=int),
+                         'rank':    np.asarray(rowRank,    dtype=int),
+                         'Parcels': np.asarray(rowParcels, dtype=int)})
+    rows = rows.groupby(['item', 'rank'], sort=True)['Parcels'].sum().reset_index()
+    item, rank = np.asarray(rows['item'], dtype=int), np.asarray(rows['rank'], dtype=int)
+    depots     = candidates[zoneNr[item], cepNr[item], rank]
+    
+    parcelCounts = pd.DataFrame({
+        'O_zone':      np.asarray(depotZones, dtype=int)[depots],
+        'D_zone':      destZones[zoneNr[item]],
+        'Parcels':     np.asarray(rows['Parcels'], dtype=int),
+        'DepotNumber': depots + 1,
+        'CEP':         np.asarray(cepList, dtype=object)[cepNr[item]]})
+    return parcelCounts, overflow
+
 
-skims = {'time': {}, 'dist': {}, }
-skims['time']['path'] = varDict['SKIMTIME']
-skims['dist']['path'] = varDict['SKIMDISTANCE']
-for skim in skims:
-    skims[skim] = read_mtx(skims[skim]['path'])
-    nSkimZones = int(len(skims[skim])**0.5)
-    skims[skim] = skims[skim].reshape((nSkimZones, nSkimZones))
-    if skim == 'time': skims[skim][6483] = skims[skim][:,6483] = 5000 # data deficiency
-    for i in range(nSkimZones): #add traveltimes to internal zonal trips
-        skims[skim][i,i] = 0.7 * np.min(skims[skim][i,skims[skim][i,:]>0])
-skimTravTime = skims['time']; skimDist = skims['dist']
-skimDist_flat = skimDist.flatten()
-del skims, skim, i
+def build_parcel_counts(destZones, nParcelsCep, depotChoice, depotZones, cepList):
+    '''
+    Create the aggregated parcel demand: one row per destination zone and
+    courier with parcels, zone after zone and courier after courier, with the
+    number of parcels in Parcels.
+    destZones:   AREANR of the destination zones
+    nParcelsCep: number of parcels per destination zone and courier
+    depotChoice: position in parcelNodes of the depot per destination zone and courier
+    depotZones:  AREANR of the parcel nodes
+    '''
+    nParcelsCep = np.asarray(nParcelsCep, dtype=int).ravel()
+    depots      = np.asarray(depotChoice, dtype=int).ravel()
+    rows        = np.where(nParcelsCep > 0)[0]
     
-zoneDict  = dict(np.transpose(np.vstack( (np.arange(1,nZones+1), zones['AREANR']) )))
-zoneDict  = {int(a):int(b) for a,b in zoneDict.items()}
-invZoneDict = dict((v, k) for k, v in zoneDict.items()) 
+    parcelCounts = pd.DataFrame({
+        'O_zone':      np.asarray(depotZones, dtype=int)[depots[rows]],
+        'D_zone':      np.repeat(np.asarray(destZones, dtype=int), len(cepList))[rows],
+        'Parcels':     nParcelsCep[rows],
+        'DepotNumber': depots[rows] + 1,
+        'CEP':         np.tile(np.asarray(cepList, dtype=object), len(destZones))[rows]})
+    return parcelCounts
+
+
+_workerSkim = None
+
+def _init_worker(shmName, shape, dtype):
+    '''
+    Attach a worker process to the parcel skim in shared memory
+    '''
+    global _workerSkim
+    shm = shared_memory.SharedMemory(name=shmName)
+    _workerSkim = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+def _parcel_counts_block(skimNrs, destZones, nParcelsCep, depotZones, cepList, cepNodeDict):
+    '''
+    Depot choice and aggregated parcel demand for one block of destination zones,
+    in a worker process (see parallel_parcel_counts)
+    '''
+    depotChoice = choose_depots(_workerSkim[1][np.asarray(skimNrs)-1], cepList, cepNodeDict)
+    return build_parcel_counts(destZones, nParcelsCep, depotChoice, depotZones, cepList)
 
-segs   = pd.read_csv(varDict['SEGS'])
-segs.index = segs['zone']
-segs = segs[segs['zone'].isin(zones['AREANR'])] #Take only segs into account for which zonal data is known as well
 
-parcelNodesPath = varDict['PARCELNODES']
-parcelNodes = read_shape(parcelNodesPath, returnGeometry=False)
-parcelNodes.index   = parcelNodes['id'].astype(int)
-parcelNodes         = parcelNodes.sort_index()    
+# Smallest depot choice (destination zones x parcel nodes) run by parallel_parcel_counts with WORKERS > 1.
+# Copying the parcel skim to shared memory and starting the pool costs more than the serial depot choice
+# below this (which takes about 0.3 s for 20000 zones and 1000 depots).
+PARALLEL_MIN_CELLS = 20_000_000
 
-for node in parcelNodes['id']:
-    parcelNodes.loc[node,'SKIMNR'] = int(invZoneDict[parcelNodes.at[int(node),'AREANR']])
-parcelNodes['SKIMNR'] = parcelNodes['SKIMNR'].astype(int)
+def parallel_parcel_counts(parcelSkim, skimNrs, destZones, nParcelsCep, depotZones, cepList, cepNodeDict, workers):
+    '''
+    Same as choose_depots followed by build_parcel_counts, with the destination
+    zones split in contiguous blocks over a pool of worker processes. The parcel
+    skim is shared with the workers through shared memory instead of being
+    pickled, and the blocks are merged in zone order, so the result (and the
+    Parcel_IDs given by expand_parcels) equals that of the serial run.
+    This only pays off for very large numbers of zones and depots (see
+    PARALLEL_MIN_CELLS), as the serial depot choice is a vectorised argmin.
+    '''
+    parcelSkim  = np.ascontiguousarray(parcelSkim)
+    skimNrs     = np.asarray(skimNrs, dtype=int)
+    destZones   = np.asarray(destZones, dtype=int)
+    nParcelsCep = np.asarray(nParcelsCep, dtype=int)
+    depotZones  = np.asarray(depotZones, dtype=int)
+    blocks      = np.array_split(np.arange(len(destZones)), workers)
+    
+    shm = shared_memory.SharedMemory(create=True, size=max(parcelSkim.nbytes, 1))
+    try:
+        np.ndarray(parcelSkim.shape, dtype=parcelSkim.dtype, buffer=shm.buf)[:] = parcelSkim
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(shm.name, parcelSkim.shape, parcelSkim.dtype)) as pool:
+            results = [pool.submit(_parcel_counts_block, skimNrs[block], destZones[block], nParcelsCep[block],
+                                   depotZones, cepList, cepNodeDict)
+                       for block in blocks]
+            parcelCounts = pd.concat([result.result() for result in results], ignore_index=True)
+    finally:
+        shm.close()
+        shm.unlink()
+    return parcelCounts
+
+
+_c2cSkim = None
+
+def _c2c_block(skim, origs, dests, nSend, attraction, beta, intrazonal, seed):
+    '''
+    Distribute the C2C parcels sent from one block of origins over the
+    destinations (see distribute_c2c). skim is the distance skim, or None in a
+    forked worker process, which uses the skim of its parent in _c2cSkim.
+    Returns the positions in origs and dests and the number of parcels of the
+    OD pairs with parcels.
+    '''
+    if skim is None:
+        skim = _c2cSkim
+    rows     = np.asarray(skim[origs-1])
+    distance = rows[:, dests-1].astype(np.float64)
+    if intrazonal is not None:
+        # Intrazonal distances from the rows of this block (see intrazonal_values)
+        values, hasMin = intrazonal_values(rows, intrazonal)
+        origPos, destPos = np.nonzero((origs[:,None] == dests[None,:]) & hasMin[:,None])
+        distance[origPos, destPos] = values[origPos]
+    distance /= 1000
+    weights  = attraction[None,:] * np.exp(-beta * distance)
+    total    = weights.sum(axis=1, keepdims=True)
+    probs    = np.divide(weights, total, out=np.zeros_like(weights), where=(total > 0))
+    counts   = np.random.default_rng(seed).multinomial(np.where(total[:,0] > 0, nSend, 0), probs)
+    origPos, destPos = np.nonzero(counts)
+    return origPos, destPos, counts[origPos, destPos]
+
+
+def distribute_c2c(skim, origs, dests, nSend, attraction, beta=0.1, seed=None, blockSize=256, workers=1, intrazonal=0.7):
+    '''
+    Distribute the C2C parcels sent from each origin (nSend, skim numbers in
+    origs) over the destinations (skim numbers in dests) with a gravity model:
+    the probability of a destination is proportional to its attraction times
+    exp(-beta * distance [km]). The distance within a zone is intrazonal times
+    the lowest positive distance from that zone (see intrazonal_values), or
+    the diagonal of the skim with intrazonal=None. The skim is read blockSize
+    origins at a time and the destinations of each block are drawn at once
+    (multinomial), so the memory use does not grow with the number of origins. The blocks can be run in parallel by workers forked
+    processes, which share the skim; each block has its own random stream
+    derived from seed, so the result does not depend on workers.
+    Returns the positions in origs and dests and the number of parcels of the
+    OD pairs with parcels.
+    '''
+    origs      = np.asarray(origs, dtype=int)
+    dests      = np.asarray(dests, dtype=int)
+    nSend      = np.asarray(nSend, dtype=int)
+    attraction = np.asarray(attraction, dtype=float)
+    starts     = range(0, len(origs), blockSize)
+    seeds      = np.random.SeedSequence(seed).spawn(len(starts))
+    blocks     = [(origs[start:start+blockSize], dests, nSend[start:start+blockSize], attraction, beta, intrazonal, blockSeed)
+                  for start, blockSeed in zip(starts, seeds)]
+    
+    global _c2cSkim
+    if workers > 1 and len(blocks) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        _c2cSkim = skim
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                results = list(pool.map(_c2c_block, [None] * len(blocks), *zip(*blocks)))
+        finally:
+            _c2cSkim = None
+    else:
+        results = [_c2c_block(skim, *block) for block in blocks]
+    
+    origPos = np.concatenate([[]] + [result[0] + start for start, result in zip(starts, results)]).astype(int)
+    destPos = np.concatenate([[]] + [result[1] for result in results]).astype(int)
+    parcels = np.concatenate([[]] + [result[2] for result in results]).astype(int)
+    return origPos, destPos, parcels
 
-cepList   = np.unique(parcelNodes['CEP'])
-cepNodes = [np.where(parcelNodes['CEP']==str(cep))[0] for cep in cepList]
 
-cepNodeDict = {}; cepZoneDict = {}; cepSkimDict = {}
-for cep in cepList: 
-    cepZoneDict[cep] = parcelNodes[parcelNodes['CEP'] == cep]['AREANR'].astype(int).tolist()
-    cepSkimDict[cep] = parcelNodes[parcelNodes['CEP'] == cep]['SKIMNR'].astype(int).tolist()
-for cepNo in range(len(cepList)):
-    cepNodeDict[cepList[cepNo]] = cepNodes[cepNo]
+def expand_parcels(parcelCounts, chunkSize=None):
+    '''
+    Expand aggregated parcel demand (a DataFrame with the number of parcels per
+    row in Parcels) to one row per parcel, with a Parcel_ID following the order
+    of the rows. Yields DataFrames of about chunkSize parcels, or of all parcels
+    at once if chunkSize is None.
+    '''
+    counts   = np.asarray(parcelCounts['Parcels'], dtype=int)
+    firstIDs = np.concatenate([[1], 1 + np.cumsum(counts)])
+    columns  = {col: np.asarray(parcelCounts[col]) for col in parcelCounts.columns if col != 'Parcels'}
+    nRows    = len(counts)
+    
+    if chunkSize is None:
+        bounds = [0, nRows]
+    else:
+        ends   = np.searchsorted(firstIDs[1:] - 1, np.arange(chunkSize, firstIDs[-1] - 1, chunkSize)) + 1
+        bounds = np.unique(np.concatenate([[0], np.minimum(ends, nRows), [nRows]]))
+    if len(bounds) < 2:
+        # No parcels: one empty DataFrame with the columns and types of the parcels
+        bounds = [0, 0]
+    
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        parcels = {'Parcel_ID': np.arange(firstIDs[start], firstIDs[end], dtype=int)}
+        for col, values in columns.items():
+            parcels[col] = np.repeat(values[start:end], counts[start:end])
+        yield pd.DataFrame(parcels)
+
+
+def write_parcels(outputPath, parcels, outputFormat='csv', compression=None, categories=None):
+    '''
+    Write the parcel demand as CSV, or as a typed columnar file ('parquet' or
+    'feather', see write_columnar). The parcels can be one DataFrame or an
+    iterable of DataFrames (e.g. from expand_parcels), written batch by batch;
+    categories then gives the values of the text columns (see write_columnar).
+    CSV written batch by batch can be compressed with 'gzip', 'bz2' or 'xz'.
+    '''
+    if outputFormat == 'csv' and isinstance(parcels, pd.DataFrame):
+        parcels.to_csv(outputPath, index=False, compression=compression)
+    elif outputFormat == 'csv':
+        openers = {None: open, 'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+        if compression not in openers:
+            raise ValueError(f"Compression {compression} is not supported for CSV output in batches, use one of {list(openers)[1:]}.")
+        with openers[compression](outputPath, 'wt', newline='') as csvFile:
+            for i, batch in enumerate(parcels):
+                batch.to_csv(csvFile, index=False, header=(i == 0))
+    else:
+        write_columnar(outputPath, parcels, fileFormat=outputFormat, compression=compression, categories=categories)
+
+
+def aggregate_parcels(parcels):
+    '''
+    Aggregate the parcels (one per row, or with counts in Parcels) to one row
+    per depot, courier, OD pair, and vehicle type and UCC flags if present,
+    with the number of parcels in Parcels
+    '''
+    keys  = ['DepotNumber', 'CEP', 'D_zone', 'O_zone']
+    keys += [col for col in ['VEHTYPE', 'FROM_UCC', 'TO_UCC'] if col in parcels.columns]
+    
+    if 'Parcels' in parcels.columns:
+        parcelsShape = parcels.groupby(keys, sort=True)['Parcels'].sum()
+    else:
+        parcelsShape = parcels.groupby(keys, sort=True).size().rename('Parcels')
+    parcelsShape = parcelsShape.reset_index()
+    parcelsShape = parcelsShape.reindex(columns=['O_zone', 'D_zone', 'Parcels', 'DepotNumber', 'CEP'] + keys[4:])
+    return parcelsShape
+
+
+def reroute_ucc(parcels, zones, probConsolidation, cumSharesVeh, vehTypes):
+    '''
+    Reroute parcels with a destination in a zero-emission zone (ZEZ) via the
+    UCC of that zone. A parcel is consolidated with probability probConsolidation:
+    its leg to the UCC keeps the original vehicle and gets TO_UCC = 1, and a new
+    leg from the UCC to the destination is added with FROM_UCC = 1 and a vehicle
+    type drawn from the cumulative shares cumSharesVeh of the UCC vehicles
+    (vehTypes gives the VEHTYPE of each). Parcel_ID is renumbered at the end.
+    '''
+    parcels['FROM_UCC'] = 0
+    parcels['TO_UCC'  ] = 0
+    
+    destZones    = np.array(parcels['D_zone'], dtype=int)
+    whereDestZEZ = np.where((np.array(zones.loc[destZones,'ZEZ']) == 1) & (probConsolidation > np.random.rand(len(parcels))))[0]
+    
+    trueDests = destZones[whereDestZEZ]
+    uccZones  = np.array(zones.loc[trueDests,'UCC_zone'], dtype=int)
+    nRerouted = len(whereDestZEZ)
+    
+    # Redirect to UCC
+    parcels.iloc[whereDestZEZ, parcels.columns.get_loc('D_zone')] = uccZones
+    parcels.iloc[whereDestZEZ, parcels.columns.get_loc('TO_UCC')] = 1
+    
+    # Add parcel set to ZEZ from UCC
+    vehicles = np.searchsorted(cumSharesVeh, np.random.rand(nRerouted), side='right')
+    vehicles = np.minimum(vehicles, len(vehTypes)-1)
+    newParcels = pd.DataFrame({
+        'Parcel_ID':   np.zeros(nRerouted, dtype=int),
+        'O_zone':      uccZones,
+        'D_zone':      trueDests,
+        'DepotNumber': np.array(parcels['DepotNumber'], dtype=int)[whereDestZEZ],
+        'CEP':         np.array(parcels['CEP'], dtype=object)[whereDestZEZ],
+        'VEHTYPE':     np.asarray(vehTypes, dtype=int)[vehicles],
+        'FROM_UCC':    np.ones(nRerouted, dtype=int),
+        'TO_UCC':      np.zeros(nRerouted, dtype=int)})
+    
+    parcels = pd.concat([parcels, newParcels], ignore_index=True)
+    parcels['Parcel_ID'] = np.arange(1, len(parcels)+1)
+    return parcels
+
+
+def parcel_kpis(parcels, zones, zoneIndex, skimDistance, cepList, nDepots):
+    '''
+    KPIs of the parcel demand (one parcel per row, or with the number of parcels
+    per row in Parcels): the parcel-km from O_zone (depot or UCC) to D_zone on
+    the distance skim (with intrazonal distances, see intrazonal_values),
+    and the number of parcels and parcel-km per courier, depot, municipality
+    of the destination (GEMEENTEN of zones) and vehicle type. With UCC flags
+    also the parcels rerouted via a UCC. All values are Python ints and
+    floats, so that the KPIs can be written as JSON.
+    '''
+    if 'Parcels' in parcels.columns:
+        weights = np.asarray(parcels['Parcels'], dtype=float)
+    else:
+        weights = np.ones(len(parcels))
+    origs = zoneIndex.skim_numbers(parcels['O_zone'])
+    dests = zoneIndex.skim_numbers(parcels['D_zone'])
+    km    = weights * skim_pairs(skimDistance, origs, dests, factor=1/1000, dtype=np.float64, intrazonal=0.7)
+    
+    def grouped(codes, names):
+        ''' Number of parcels and parcel-km per group (codes: position in names) '''
+        nParcels = np.bincount(codes, weights=weights, minlength=len(names))
+        parcelKm = np.bincount(codes, weights=km,      minlength=len(names))
+        return {str(name): {'Parcels': int(round(n)), 'Parcel Km': round(float(k), 3)}
+                for name, n, k in zip(names, nParcels, parcelKm) if n > 0}
+    
+    # Municipality of each destination, 'Unknown' for zones outside zones
+    muniCodes, muniNames = pd.factorize(zones['GEMEENTEN'])
+    destPos   = zones.index.get_indexer(np.asarray(parcels['D_zone'], dtype=int))
+    destMunis = np.where(destPos >= 0, muniCodes[destPos], len(muniNames))
+    
+    vehTypes, vehCodes = np.unique(np.asarray(parcels['VEHTYPE'], dtype=int), return_inverse=True)
+    
+    KPIs = {
+        'Parcel Km':            round(float(km.sum()), 3),
+        'Per CEP':              grouped(pd.Categorical(parcels['CEP'], categories=cepList).codes, cepList),
+        'Per Depot':            grouped(np.asarray(parcels['DepotNumber'], dtype=int) - 1, range(1, nDepots+1)),
+        'Per Municipality':     grouped(destMunis, list(muniNames) + ['Unknown']),
+        'Per Vehicle Type':     grouped(vehCodes, vehTypes)}
+    
+    if 'TO_UCC' in parcels.columns:
+        toUCC   = np.asarray(parcels['TO_UCC'])   == 1
+        fromUCC = np.asarray(parcels['FROM_UCC']) == 1
+        nDirect = weights[~fromUCC].sum()
+        KPIs['UCC'] = {
+            'Parcels Via UCC':    int(round(weights[toUCC].sum())),
+            'Share Via UCC':      round(float(weights[toUCC].sum() / nDirect), 6) if nDirect > 0 else 0.0,
+            'Parcel Km To UCC':   round(float(km[toUCC].sum()), 3),
+            'Parcel Km From UCC': round(float(km[fromUCC].sum()), 3)}
+    return KPIs
 
-KPIs = {}
 
 #%%
 
@@ -248,11 +810,9 @@ import numpy as np
 import pandas as pd
 import time
 import datetime
-from __functions__ import read_mtx, read_shape
+from __functions__ import read_mtx, open_mtx, read_mtx_intrazonal, skim_columns, read_shape, read_points, ZoneIndex, InputCache, create_geojson, write_columnar
 
-# Modules nodig voor de user interface
-import tkinter as tk
-from tkinter.ttk import Progressbar
+# Modules nodig voor de user interface (tkinter is imported by the GUI itself)
 import zlib
 import base64
 import tempfile
@@ -276,6 +836,9 @@ class Root:
         '''
         Initialize a GUI object
         '''        
+        import tkinter as tk
+        from tkinter.ttk import Progressbar
+        
         # Set graphics parameters
         self.width  = 500
         self.height = 60
@@ -327,6 +890,8 @@ class Root:
         '''
         Pop up a window with an error message
         '''
+        import tkinter as tk
+        
         windowError = tk.Toplevel(self.root)
         windowError.title(title)
         windowError.geometry(f'{size[0]}x{size[1]}+0+{200+50+self.height}')
@@ -344,6 +909,7 @@ class Root:
 
 def actually_run_module(args):
 
+    profiler = cProfiler = log_file = None
     try:
         # -------------------- Define datapaths -----------------------------------
         
@@ -351,6 +917,11 @@ def actually_run_module(args):
         
         root    = args[0]
         varDict = args[1]
+        inputs  = args[2] if len(args) > 2 else ModelInputs(varDict)
+        result  = args[3] if len(args) > 3 else {}
+        
+        KPIs = {}
+        outputFiles = []
                 
         if root != '':
             root.progressBar['value'] = 0
@@ -359,82 +930,60 @@ def actually_run_module(args):
         datapathI = varDict['INPUTFOLDER']
         datapathO = varDict['OUTPUTFOLDER']
         # datapathP = varDict['PARAMFOLDER']
-        zonesPath        = varDict['ZONES']
-        skimTravTimePath = varDict['SKIMTIME']
-        skimDistancePath = varDict['SKIMDISTANCE']
-        parcelNodesPath  = varDict['PARCELNODES']
-        cepSharesPath    = varDict['CEP_SHARES']
-        segsPath         = varDict['SEGS']    
         label            = varDict['LABEL']
+        outputFormat     = varDict.get('OUTPUT_FORMAT', 'csv')
+        aggregated       = varDict.get('OUTPUT_AGGREGATED', False)
+        batchSize        = varDict.get('BATCH_SIZE', None)
+        workers          = varDict.get('WORKERS', 1)
+        studyAreaSkim    = varDict.get('SKIM_STUDYAREA', False)
+        depotCapacity    = varDict.get('DEPOT_CAPACITY', None)
         
         parcelsPerHH     = varDict['PARCELS_PER_HH']
         parcelsPerEmpl   = varDict['PARCELS_PER_EMPL']
         parcelSuccessB2B = varDict['PARCELS_SUCCESS_B2B']
         parcelSuccessB2C = varDict['PARCELS_SUCCESS_B2C']
+        if varDict.get('C2C_DISTRIBUTION', False):
+            # PARCELS_PER_HH includes the C2C parcels. The local ones (Local2Local) are distributed
+            # between the zones in the C2C stage instead of delivered from the depots
+            parcelsPerHH -= varDict['PARCELS_PER_HH_C2C'] * varDict.get('Local2Local', 1.0)
 
-        log_file = open(datapathO + "Logfile_ParcelDemand.log", "w")
+        log_file = open(datapathO + varDict.get('LOGFILE', "Logfile_ParcelDemand.log"), "w")
         log_file.write("Start simulation at: " + datetime.datetime.now().strftime("%y-%m-%d %H:%M")+"\n")
-         
+        
+        # Wall time, CPU time and memory per stage (PROFILE), optionally with tracemalloc and cProfile
+        profiler = StageProfiler(traceMemory=varDict.get('PROFILE_TRACEMALLOC', False))
+        if varDict.get('PROFILE_CPROFILE', False):
+            import cProfile
+            cProfiler = cProfile.Profile()
+            cProfiler.enable()
             
         # ---------------------------- Import data --------------------------------
         print('Importing data...'), log_file.write('Importing data...\n')
-        zones = read_shape(zonesPath)
-        zones = pd.DataFrame(zones).sort_values('AREANR')
-        zones.index = zones['AREANR']
-        supCoordinates = pd.read_csv(varDict['ExternalZones'], sep=',')
-        supCoordinates.index = supCoordinates['AREANR']
-        
-        zonesX = {}
-        zonesY = {}
-        for areanr in zones.index:
-            zonesX[areanr] = zones.at[areanr, 'X']
-            zonesY[areanr] = zones.at[areanr, 'Y']
-        for areanr in supCoordinates.index:
-            zonesX[areanr] = supCoordinates.at[areanr, 'Xcoor']
-            zonesY[areanr] = supCoordinates.at[areanr, 'Ycoor']     
-            
-        nIntZones = len(zones)
-        nSupZones = 43
-        zoneDict  = dict(np.transpose(np.vstack( (np.arange(1,nIntZones+1), zones['AREANR']) )))
-        zoneDict  = {int(a):int(b) for a,b in zoneDict.items()}
-        for i in range(nSupZones):
-            zoneDict[nIntZones+i+1] = 99999900 + i + 1
-        invZoneDict = dict((v, k) for k, v in zoneDict.items())   
-                
-        segs              = pd.read_csv(segsPath)
-        segs.index        = segs['zone']
-        
-        parcelNodes, coords = read_shape(parcelNodesPath, returnGeometry=True)
-        parcelNodes['X']    = [coords[i]['coordinates'][0] for i in range(len(coords))]
-        parcelNodes['Y']    = [coords[i]['coordinates'][1] for i in range(len(coords))]
-        parcelNodes.index   = parcelNodes['id'].astype(int)
-        parcelNodes         = parcelNodes.sort_index()    
-        nParcelNodes        = len(parcelNodes)
-           
-        cepShares = pd.read_csv(cepSharesPath, index_col=0)
-        cepList   = np.unique(parcelNodes['CEP'])
-        cepNodes = [np.where(parcelNodes['CEP']==str(cep))[0] for cep in cepList]
-        cepNodeDict = {}
-        for cepNo in range(len(cepList)):
-            cepNodeDict[cepList[cepNo]] = cepNodes[cepNo]
+        profiler.stage('import data')
+        zones        = inputs.zones
+        zoneIndex    = inputs.zoneIndex
+        segs         = inputs.segs
+        parcelNodes  = inputs.parcelNodes
+        cepShares    = inputs.cepShares
+        cepList      = inputs.cepList
+        cepNodeDict  = inputs.cepNodeDict
         
         
         # ------------------ Get skim data and make parcel skim --------------------
-        skimTravTime = read_mtx(skimTravTimePath)
-        nZones   = int(len(skimTravTime)**0.5)
-        parcelSkim = np.zeros((nZones, nParcelNodes))
-            
         # Skim with travel times between parcel nodes and all other zones
-        i = 0
-        for parcelNodeZone in parcelNodes['AREANR']:
-            orig = invZoneDict[parcelNodeZone]
-            dest = 1 + np.arange(nZones)
-            parcelSkim[:,i] = np.round( (skimTravTime[(orig-1)*nZones+(dest-1)] / 3600),4)     
-            i += 1
+        profiler.stage('read skim')
+        skimTravTime = inputs.skimTravTime
+        profiler.stage('parcel skim')
+        if studyAreaSkim:
+            # Only the rows of the zones in the study area (see ModelInputs.studySkimNrs)
+            parcelSkim = inputs.studyParcelSkim
+        else:
+            parcelSkim = inputs.parcelSkim
         
         
         # ---- Generate parcels each zone based on households and select a parcel node for each parcel -----
         print('Generating parcels...'), log_file.write('Generating parcels...\n')
+        profiler.stage('generate parcels')
         
         # Filter the zones of the study area (edit 24/4)
         
@@ -454,41 +1003,49 @@ def actually_run_module(args):
             zones['parcels_' + str(cep)] = np.round(cepShares['ShareTotal'][cep] * zones['parcels'], 0)
             zones['parcels_' + str(cep)] = zones['parcels_' + str(cep)].astype(int)
         
-        # Total number of parcels per courier
-        nParcels  = int(zones[["parcels_"+str(cep) for cep in cepList]].sum().sum())
-        
-        # Put parcel demand in Numpy array (faster indexing)
-        cols    = ['Parcel_ID', 'O_zone', 'D_zone', 'DepotNumber']
-        parcels = np.zeros((nParcels,len(cols)), dtype=int)
-        parcelsCep = np.array(['' for i in range(nParcels)], dtype=object)
-        
         # Now determine for each zone and courier from which depot the parcels are delivered
-        count = 0
-        for zoneID in zones['AREANR'] : 
-            
-            if zones['parcels'][zoneID] > 0: # Go to next zone if no parcels are delivered here
-            
-                for cep in cepList:
-                    # Select dc based on min in parcelSkim
-                    parcelNodeIndex = cepNodeDict[cep][parcelSkim[invZoneDict[zoneID]-1,cepNodeDict[cep]].argmin()]
-                
-                    # Fill allParcels with parcels, zone after zone. Parcels consist of ID, D and O zone and parcel node number
-                    # in ongoing df from index count-1 the next x=no. of parcels rows, fill the cell in the column Parcel_ID with a number 
-                    n = zones.loc[zoneID,'parcels_' + str(cep)]
-                    parcels[count:count+n,0]  = np.arange(count+1, count+1+n,dtype=int)                    
-                    parcels[count:count+n,1]  = parcelNodes['AREANR'][parcelNodeIndex+1]
-                    parcels[count:count+n,2]  = zoneID
-                    parcels[count:count+n,3]  = parcelNodeIndex + 1
-                    parcelsCep[count:count+n] = cep
-                
-                    count += zones['parcels_' + str(cep)][zoneID]
-        
-        # Put the parcel demand data back in a DataFrame
-        parcels = pd.DataFrame(parcels, columns=cols)
-        parcels['CEP'] = parcelsCep
+        skimNrs     = zoneIndex.skim_numbers(zones['AREANR'])
+        nParcelsCep = np.array(zones[['parcels_' + str(cep) for cep in cepList]], dtype=int)
+        
+        # Number of parcels per zone and courier, with the O zone and parcel node number of the depot
+        # (with DEPOT_CAPACITY, assigned to the DEPOT_TOPK nearest depots within their capacities)
+        # (with WORKERS, in parallel when there are at least PARALLEL_MIN_CELLS zones x depots)
+        profiler.stage('depot assignment')
+        parallel = workers > 1 and len(zones) * len(parcelNodes) >= PARALLEL_MIN_CELLS
+        if depotCapacity is None and not parallel:
+            depotChoice = inputs.studyDepotChoice if studyAreaSkim else inputs.depotChoice[skimNrs-1]
+        
+        if depotCapacity is not None:
+            # Capacity per depot: the same for all depots, or a column of the parcel nodes
+            if isinstance(depotCapacity, str):
+                capacity = np.asarray(parcelNodes[depotCapacity], dtype=float)
+            else:
+                capacity = np.full(len(parcelNodes), float(depotCapacity))
+            candidates, candidateTimes = inputs.studyDepotCandidates if studyAreaSkim else \
+                [values[skimNrs-1] for values in inputs.depotCandidates]
+            parcelCounts, overflow = assign_depots_capacitated(zones['AREANR'], nParcelsCep, candidates, candidateTimes,
+                                                               capacity, parcelNodes['AREANR'], cepList)
+            KPIs['Parcels Over Depot Capacity'] = int(overflow.sum())
+            print(f'Parcels over depot capacity: {overflow.sum()}'), log_file.write(f'Parcels over depot capacity: {overflow.sum()}\n')
+        elif parallel:
+            print(f'Using {workers} worker processes'), log_file.write(f'Using {workers} worker processes\n')
+            skimRows     = np.arange(1, len(zones)+1) if studyAreaSkim else skimNrs
+            parcelCounts = parallel_parcel_counts(parcelSkim, skimRows, zones['AREANR'], nParcelsCep, parcelNodes['AREANR'],
+                                                  cepList, cepNodeDict, workers)
+        else:
+            parcelCounts = build_parcel_counts(zones['AREANR'], nParcelsCep, depotChoice, parcelNodes['AREANR'], cepList)
         
         # Default vehicle type for parcel deliveries: vans
-        parcels['VEHTYPE'] = 7
+        parcelCounts['VEHTYPE'] = 7
+        
+        # Put the parcel demand in a DataFrame, one row per parcel (not needed for aggregated output without UCCs)
+        # Without UCCs the parcels can be streamed to the output in batches of BATCH_SIZE parcels
+        if aggregated and label != 'UCC':
+            parcels = None
+        elif batchSize and label != 'UCC':
+            parcels = expand_parcels(parcelCounts, chunkSize=batchSize)
+        else:
+            parcels = next(expand_parcels(parcelCounts))
 
         # Rerouting through UCCs in the UCC-scenario
         if label == 'UCC': 
@@ -500,9 +1057,20 @@ def actually_run_module(args):
             ls = 6
 
             # Write the REF parcel demand
-            print(f"Writing parcels to {datapathO}ParcelDemand_REF.csv"), log_file.write(f"Writing parcels to {datapathO}ParcelDemand_REF.csv\n")
-            parcels.to_csv(f"{datapathO}ParcelDemand_REF.csv", index=False)  
+            profiler.stage('write output')
+            if aggregated:
+                outputPath = f"{datapathO}ParcelDemandAggregated_REF.{outputFormat}"
+                print(f"Writing parcels to {outputPath}"), log_file.write(f"Writing parcels to {outputPath}\n")
+                write_parcels(outputPath, aggregate_parcels(parcelCounts), outputFormat, varDict.get('OUTPUT_COMPRESSION', None))
+                outputFiles.append(outputPath)
+            else:
+                outputPath = f"{datapathO}ParcelDemand_REF.{outputFormat}"
+                print(f"Writing parcels to {outputPath}"), log_file.write(f"Writing parcels to {outputPath}\n")
+                write_parcels(outputPath, parcels, outputFormat, varDict.get('OUTPUT_COMPRESSION', None))
+                outputFiles.append(outputPath)
 
+            profiler.stage('ucc rerouting')
+            
             # Consolidation potential per logistic segment (for UCC scenario)
             probConsolidation = np.array(pd.read_csv(datapathI + 'ConsolidationPotential.csv', index_col='Segment'))
             
@@ -512,191 +1080,122 @@ def actually_run_module(args):
             # Assume no consolidation potential and vehicle type switch for dangerous goods
             sharesUCC = np.array(sharesUCC)[:-1,:-1]
             
-            # Only vehicle shares (summed up combustion types)
-            sharesVehUCC = np.zeros((nLogSeg-1,len(vtNamesUCC)))
-            for ls in range(nLogSeg-1):
-                sharesVehUCC[ls,0] = np.sum(sharesUCC[ls,0:5])
-                sharesVehUCC[ls,1] = np.sum(sharesUCC[ls,5:10])
-                sharesVehUCC[ls,2] = np.sum(sharesUCC[ls,10:15])
-                sharesVehUCC[ls,3] = np.sum(sharesUCC[ls,15:20])
-                sharesVehUCC[ls,4] = np.sum(sharesUCC[ls,20:25])
-                sharesVehUCC[ls,5] = np.sum(sharesUCC[ls,25:30])            
-                sharesVehUCC[ls,6] = np.sum(sharesUCC[ls,30:35])
-                sharesVehUCC[ls,:] = np.cumsum(sharesVehUCC[ls,:]) / np.sum(sharesVehUCC[ls,:])
+            # Only vehicle shares (summed up combustion types), cumulative
+            sharesVehUCC = sharesUCC.reshape(nLogSeg-1, len(vtNamesUCC), -1).sum(axis=2)
+            sharesVehUCC = np.cumsum(sharesVehUCC, axis=1) / np.sum(sharesVehUCC, axis=1)[:,None]
 
             # Couple these vehicle types to Harmony vehicle types
-            vehUccToVeh = {0:8, 1:9, 2:7, 3:1, 4:5, 5:6, 6:6}                
+            vehUccToVeh = np.array([8, 9, 7, 1, 5, 6, 6])
 
             print('Redirecting parcels via UCC...'), log_file.write('Redirecting parcels via UCC...\n')
             
-            parcels['FROM_UCC'] = 0
-            parcels['TO_UCC'  ] = 0
-          
-            destZones    = np.array(parcels['D_zone'].astype(int))
-            depotNumbers = np.array(parcels['DepotNumber'].astype(int))
-            whereDestZEZ = np.where((zones['ZEZ'][destZones]==1) & (probConsolidation[ls][0] > np.random.rand(len(parcels))))[0]
-                        
-            newParcels = np.zeros(parcels.shape, dtype=object)
-
-            count = 0
-            
-            for i in whereDestZEZ:
-                                  
-                trueDest = destZones[i]
-                
-                # Redirect to UCC
-                parcels.at[i,'D_zone'] = zones['UCC_zone'][trueDest]
-                parcels.at[i,'TO_UCC'] = 1
-                
-                # Add parcel set to ZEZ from UCC
-                newParcels[count, 1] = zones['UCC_zone'][trueDest]  # Origin
-                newParcels[count, 2] = trueDest             # Destination
-                newParcels[count, 3] = depotNumbers[i]      # Depot ID
-                newParcels[count, 4] = parcelsCep[i]        # Courier name
-                newParcels[count, 5] = vehUccToVeh[np.where(sharesVehUCC[ls,:]>np.random.rand())[0][0]] # Vehicle type
-                newParcels[count, 6] = 1                    # From UCC
-                newParcels[count, 7] = 0                    # To UCC
-                
-                count += 1
-
-            newParcels = pd.DataFrame(newParcels)
-            newParcels.columns = parcels.columns            
-            newParcels = newParcels.iloc[np.arange(count),:]
-            
-            dtypes = {'Parcel_ID':int, 'O_zone':int,  'D_zone':int,   'DepotNumber':int, \
-                      'CEP':str,       'VEHTYPE':int, 'FROM_UCC':int, 'TO_UCC':int}
-            for col in dtypes.keys():
-                newParcels[col] = newParcels[col].astype(dtypes[col])
-            
-            parcels = parcels.append(newParcels)        
-            parcels.index = np.arange(len(parcels))
-            parcels['Parcel_ID'] = np.arange(1,len(parcels)+1)
-            
-            nParcels = len(parcels)
+            parcels = reroute_ucc(parcels, zones, probConsolidation[ls][0], sharesVehUCC[ls,:], vehUccToVeh)
             
             
         # ------------------------- Prepare output -------------------------------- 
-        print(f"Writing parcels CSV to     {datapathO}ParcelDemand_{label}.csv"), log_file.write(f"Writing parcels to {datapathO}ParcelDemand_{label}.csv\n")
-        parcels.to_csv(f"{datapathO}ParcelDemand_{label}.csv", index=False)  
-         
-        
+        profiler.stage('write output')
+        # Aggregate to number of parcels per depot, courier, OD pair, vehicle type and UCC flags
+        if aggregated or varDict.get('WRITE_GEOJSON', False):
+            parcelsShape = aggregate_parcels(parcels if label == 'UCC' else parcelCounts)
+        
+        if aggregated:
+            outputPath = f"{datapathO}ParcelDemandAggregated_{label}.{outputFormat}"
+            print(f"Writing parcels {outputFormat.upper()} to     {outputPath}"), log_file.write(f"Writing parcels to {outputPath}\n")
+            write_parcels(outputPath, parcelsShape, outputFormat, varDict.get('OUTPUT_COMPRESSION', None))
+            outputFiles.append(outputPath)
+            nParcels = int(parcelsShape['Parcels'].sum())
+        else:
+            outputPath = f"{datapathO}ParcelDemand_{label}.{outputFormat}"
+            print(f"Writing parcels {outputFormat.upper()} to     {outputPath}"), log_file.write(f"Writing parcels to {outputPath}\n")
+            write_parcels(outputPath, parcels, outputFormat, varDict.get('OUTPUT_COMPRESSION', None), categories={'CEP': cepList})
+            outputFiles.append(outputPath)
+            nParcels = len(parcels) if label == 'UCC' else int(parcelCounts['Parcels'].sum())
         
-        KPIs ["Number Of Parcels"] = len(parcels)
         
         
+        KPIs ["Number Of Parcels"] = nParcels
         
         
         
         
-        # # Aggregate to number of parcels per zone and export to geojson
-        # print(f"Writing parcels GeoJSON to {datapathO}ParcelDemand_{label}.geojson"), log_file.write(f"Writing shapefile to {datapathO}ParcelDemand_{label}.geojson\n")
-        # if label == 'UCC':     
-        #     parcelsShape = pd.pivot_table(parcels, values=['Parcel_ID'], index=["DepotNumber", 'CEP','D_zone', 'O_zone', 'VEHTYPE', 'FROM_UCC', 'TO_UCC'],\
-        #                                   aggfunc = {'DepotNumber': np.mean, 'CEP':     'first',  'O_zone': np.mean, 'D_zone': np.mean, 'Parcel_ID': 'count', \
-        #                                              'VEHTYPE':     np.mean, 'FROM_UCC': np.mean, 'TO_UCC': np.mean})
-        #     parcelsShape = parcelsShape.rename(columns={'Parcel_ID':'Parcels'})
-        #     parcelsShape = parcelsShape.set_index(np.arange(len(parcelsShape)))
-        #     parcelsShape = parcelsShape.reindex(columns=[ 'O_zone','D_zone', 'Parcels', 'DepotNumber', 'CEP','VEHTYPE', 'FROM_UCC', 'TO_UCC'])
-        #     parcelsShape = parcelsShape.astype({'DepotNumber': int, 'O_zone': int, 'D_zone': int, 'Parcels': int, 'VEHTYPE': int, 'FROM_UCC': int, 'TO_UCC': int})
         
-        # else:
-        #     parcelsShape = pd.pivot_table(parcels, values=['Parcel_ID'], index=["DepotNumber", 'CEP', 'D_zone', 'O_zone'],\
-        #                                   aggfunc = {'DepotNumber': np.mean, 'CEP':'first', 'O_zone': np.mean, 'D_zone': np.mean, 'Parcel_ID': 'count'})
-        #     parcelsShape = parcelsShape.rename(columns={'Parcel_ID':'Parcels'})
-        #     parcelsShape = parcelsShape.set_index(np.arange(len(parcelsShape)))
-        #     parcelsShape = parcelsShape.reindex(columns=[ 'O_zone','D_zone', 'Parcels', 'DepotNumber', 'CEP'])
-        #     parcelsShape = parcelsShape.astype({'DepotNumber': int, 'O_zone': int, 'D_zone': int, 'Parcels': int})
-
-
-        # # Initialize arrays with coordinates        
-        # Ax = np.zeros(len(parcelsShape), dtype=int)
-        # Ay = np.zeros(len(parcelsShape), dtype=int)
-        # Bx = np.zeros(len(parcelsShape), dtype=int)
-        # By = np.zeros(len(parcelsShape), dtype=int)
         
-        # # Determine coordinates of LineString for each trip
-        # depotIDs = np.array(parcelsShape['DepotNumber'])
-        # for i in parcelsShape.index:
-        #     if label == 'UCC' and parcelsShape.at[i, 'FROM_UCC'] == 1:
-        #             Ax[i] = zonesX[parcelsShape['O_zone'][i]]
-        #             Ay[i] = zonesY[parcelsShape['O_zone'][i]]
-        #             Bx[i] = zonesX[parcelsShape['D_zone'][i]]
-        #             By[i] = zonesY[parcelsShape['D_zone'][i]]
-        #     else:
-        #         Ax[i] = parcelNodes['X'][depotIDs[i]]
-        #         Ay[i] = parcelNodes['Y'][depotIDs[i]]
-        #         Bx[i] = zonesX[parcelsShape['D_zone'][i]]
-        #         By[i] = zonesY[parcelsShape['D_zone'][i]]
-                
-        # Ax = np.array(Ax, dtype=str)
-        # Ay = np.array(Ay, dtype=str)
-        # Bx = np.array(Bx, dtype=str)
-        # By = np.array(By, dtype=str)
-        # nRecords = len(parcelsShape)
-        
-        # with open(datapathO + f"ParcelDemand_{label}.geojson", 'w') as geoFile:
-        #     geoFile.write('{\n' + '"type": "FeatureCollection",\n' + '"features": [\n')
-        #     for i in range(nRecords-1):
-        #         outputStr = ""
-        #         outputStr = outputStr + '{ "type": "Feature", "properties": '
-        #         outputStr = outputStr + str(parcelsShape.loc[i,:].to_dict()).replace("'",'"')
-        #         outputStr = outputStr + ', "geometry": { "type": "LineString", "coordinates": [ [ '
-        #         outputStr = outputStr + Ax[i] + ', ' + Ay[i] + ' ], [ '
-        #         outputStr = outputStr + Bx[i] + ', ' + By[i] + ' ] ] } },\n'
-        #         geoFile.write(outputStr)
-        #         if i%int(nRecords/10) == 0:
-        #             print('\t' + str(int(round((i / nRecords)*100, 0))) + '%', end='\r')
-                    
-        #     # Bij de laatste feature moet er geen komma aan het einde
-        #     i += 1
-        #     outputStr = ""
-        #     outputStr = outputStr + '{ "type": "Feature", "properties": '
-        #     outputStr = outputStr + str(parcelsShape.loc[i,:].to_dict()).replace("'",'"')
-        #     outputStr = outputStr + ', "geometry": { "type": "LineString", "coordinates": [ [ '
-        #     outputStr = outputStr + Ax[i] + ', ' + Ay[i] + ' ], [ '
-        #     outputStr = outputStr + Bx[i] + ', ' + By[i] + ' ] ] } }\n'
-        #     geoFile.write(outputStr)
-        #     geoFile.write(']\n')
-        #     geoFile.write('}')
+        # Export the aggregated parcels to geojson
+        if varDict.get('WRITE_GEOJSON', False):
+            geoPath = f"{datapathO}ParcelDemand_{label}.geojson" + ('.gz' if varDict.get('GEOJSON_GZIP', False) else '')
+            print(f"Writing parcels GeoJSON to {geoPath}"), log_file.write(f"Writing GeoJSON to {geoPath}\n")
+            
+            # Lines from the depot (or from the UCC) to the destination zone
+            depotIDs = np.array(parcelsShape['DepotNumber'], dtype=int)
+            parcelsShape['Ax'] = np.array(parcelNodes['X'])[depotIDs-1]
+            parcelsShape['Ay'] = np.array(parcelNodes['Y'])[depotIDs-1]
+            if 'FROM_UCC' in parcelsShape.columns:
+                fromUCC = np.where(parcelsShape['FROM_UCC'] == 1)[0]
+                uccX, uccY = zoneIndex.coordinates(parcelsShape['O_zone'].iloc[fromUCC])
+                parcelsShape.iloc[fromUCC, parcelsShape.columns.get_loc('Ax')] = uccX
+                parcelsShape.iloc[fromUCC, parcelsShape.columns.get_loc('Ay')] = uccY
+            parcelsShape['Bx'], parcelsShape['By'] = zoneIndex.coordinates(parcelsShape['D_zone'])
+            
+            create_geojson(geoPath, parcelsShape, 'Ax', 'Ay', 'Bx', 'By', properties=parcelsShape.columns[:-4])
+            outputFiles.append(geoPath)
+        
+        # ------------------------- C2C distribution --------------------------------
+        # The local C2C parcels (Local2Local of the C2C parcels per household) are sent from each zone of the study area
+        # to the other zones of the study area, distributed with a gravity model on the distance skim
+        # (they are not in the parcels from the depots above, see parcelsPerHH)
+        if varDict.get('C2C_DISTRIBUTION', False):
+            profiler.stage('c2c distribution')
+            print('Distributing C2C parcels...'), log_file.write('Distributing C2C parcels...\n')
+            
+            households = np.asarray(segs.loc[zones['AREANR'], '1: woningen'], dtype=float)
+            seedC2C    = varDict.get('C2C_SEED', None)
+            
+            # Round the expected number of parcels per zone stochastically, so that the total is not biased in small zones
+            expected   = households * varDict['PARCELS_PER_HH_C2C'] * varDict.get('Local2Local', 1.0)
+            nSendC2C   = np.floor(expected).astype(int)
+            nSendC2C  += np.random.default_rng(seedC2C).random(len(expected)) < (expected - nSendC2C)
+            origPos, destPos, nParcelsC2C = distribute_c2c(inputs.skimDistance, skimNrs, skimNrs, nSendC2C, households,
+                                                           beta=varDict.get('C2C_BETA', 0.1), seed=seedC2C,
+                                                           blockSize=varDict.get('C2C_BLOCKSIZE', 256), workers=workers)
+            
+            areanr     = np.asarray(zones['AREANR'], dtype=int)
+            parcelsC2C = pd.DataFrame({'O_zone': areanr[origPos], 'D_zone': areanr[destPos], 'Parcels': nParcelsC2C})
+            outputPath = f"{datapathO}ParcelDemandC2C_{label}.{outputFormat}"
+            print(f"Writing C2C parcels to {outputPath}"), log_file.write(f"Writing C2C parcels to {outputPath}\n")
+            write_parcels(outputPath, parcelsC2C, outputFormat, varDict.get('OUTPUT_COMPRESSION', None))
+            outputFiles.append(outputPath)
+            
+            KPIs['Number Of C2C Parcels'] = int(nParcelsC2C.sum())
         
+        profiler.stage('kpis')
         KPIfile = varDict['OUTPUTFOLDER'] + 'KPI_' + varDict['LABEL']+'.json'
     
     # Write KPIs as Json
     
         print('Gathering KPIs')
-        # For some reason, json doesn't like np.int or floats
-        for index, key in enumerate(KPIs):
-            # print(key)
-            if type(KPIs[key]) == 'dict':
-                for i,k in enumerate (key):
-                    print(k)
-                    if type(key[k]) == 'dict':
-                        for j,l in enumerate(k):
-                            try:
-                                val = k[l].item() 
-                                k[l] = val
-                                key[k] = k
-                            except:
-                                a=1
-                    else:
-                        try:
-                            val = key[k].item() 
-                            key[k] = val
-                            KPIs[key] = key
-                        except:
-                            a=1
-            else:
-                try:
-                    val = KPIs[key].item()  
-                    KPIs[key] = val
-                except:
-                    a=1
-        # print(KPIs)
-        
+        # Parcel counts and parcel-km per courier, depot, municipality and vehicle type (from the aggregated
+        # parcel counts, or from the parcels with their UCC legs in the UCC scenario)
+        KPIs.update(parcel_kpis(parcels if label == 'UCC' else parcelCounts, inputs.zones, zoneIndex,
+                                inputs.skimDistance, cepList, len(parcelNodes)))
         
         f = open(KPIfile, "w")
         json.dump(KPIs, f,indent = 2)
         f.close()
+        outputFiles.append(KPIfile)
+        
+        if varDict.get('PROFILE_CPROFILE', False):
+            cProfiler.disable()
+            cProfiler.dump_stats(f"{datapathO}profile_{label}.prof")
+            outputFiles.append(f"{datapathO}profile_{label}.prof")
+        profile = profiler.report()
+        if varDict.get('PROFILE', False):
+            with open(f"{datapathO}profile_{label}.json", "w") as f:
+                json.dump(profile, f, indent=2)
+            outputFiles.append(f"{datapathO}profile_{label}.json")
+        
+        result['KPIs']    = KPIs
+        result['profile'] = profile
+        result['outputs'] = outputFiles
         
         
         KPI_Json = json.dumps(KPIs, indent = 2) 
@@ -724,11 +1223,13 @@ def actually_run_module(args):
         
     except BaseException:
         import sys
-        log_file.write(str(sys.exc_info()[0])), log_file.write("\n")
         import traceback
-        log_file.write(str(traceback.format_exc())), log_file.write("\n")
-        log_file.write("Execution failed!")
-        log_file.close()
+        # The run can fail before the log file is opened (e.g. a missing OUTPUTFOLDER)
+        if log_file is not None:
+            log_file.write(str(sys.exc_info()[0])), log_file.write("\n")
+            log_file.write(str(traceback.format_exc())), log_file.write("\n")
+            log_file.write("Execution failed!")
+            log_file.close()
         
         if root != '':
             # Use this information to display as error message in GUI
@@ -743,6 +1244,14 @@ def actually_run_module(args):
                 return root.returnInfo
         else:
             return [1, [sys.exc_info()[0], traceback.format_exc()]]
+    
+    finally:
+        # Also stop the profilers of a failed run, which would otherwise keep
+        # tracing in a --serve or batch process
+        if cProfiler is not None:
+            cProfiler.disable()
+        if profiler is not None:
+            profiler.close()
  
     
     
@@ -808,24 +1317,178 @@ def actually_run_module(args):
 #         varDict = {}
 
 #%%
-print('Starting Parcel Generation')
-actually_run_module(args)
+_batchRuns = []
 
+def _run_scenario(i):
+    '''
+    Run scenario i of _batchRuns, in a worker process (see run_batch)
+    '''
+    return actually_run_module(_batchRuns[i])
 
-print('Parcel Generation Completed')
 
+def run_batch(varDict, batchFile, inputs, workers=1):
+    '''
+    Run all scenarios in batchFile: a JSON list with for each scenario the
+    parameters that differ from varDict (at least its LABEL), and optionally a
+    parameter file in PARAMS (in the input folder) that is read first. The
+    inputs, including the depot choice, are read once and shared by all
+    scenarios with the same input files. With workers > 1 that many scenarios
+    are run at the same time in forked processes. Each scenario writes its own
+    log file, Logfile_ParcelDemand_{LABEL}.log, unless it sets LOGFILE.
+    Returns the returnInfo of each scenario.
+    '''
+    with open(batchFile) as f:
+        scenarios = json.load(f)
+    
+    parallel = workers > 1 and 'fork' in multiprocessing.get_all_start_methods()
+    
+    _batchRuns.clear()
+    returnInfo = []
+    for scenario in scenarios:
+        scenario     = dict(scenario)
+        scenarioDict = dict(varDict)
+        if 'PARAMS' in scenario:
+            with open(scenarioDict['INPUTFOLDER'] + scenario.pop('PARAMS')) as params_file:
+                read_params(params_file, scenarioDict)
+        scenarioDict.update(scenario)
+        if 'LOGFILE' not in scenario:
+            scenarioDict['LOGFILE'] = f"Logfile_ParcelDemand_{scenarioDict['LABEL']}.log"
+        
+        inputs = inputs.with_params(scenarioDict)
+        if parallel:
+            # Read the inputs before forking, so that the workers share them
+            inputs.preload()
+            _batchRuns.append(['', scenarioDict, inputs])
+        else:
+            returnInfo.append(actually_run_module(['', scenarioDict, inputs]))
+    
+    if parallel:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+            returnInfo = list(pool.map(_run_scenario, range(len(_batchRuns))))
+    return returnInfo
 
 
+_inputs = None
 
-#         for i in range(len(args)):
-#             varDict[varStrings[i]] = args[i]
-            
-#         # Run the module
-#         main(varDict)
+def generate_parcels(varDict, inputs=None):
+    '''
+    Run the parcel demand model for the parameters in varDict (see
+    generate_args and read_params) and return a dict with the KPIs and the
+    paths of the output files. Raises a RuntimeError if the run fails.
+    Without inputs, the inputs of the previous call are reused as far as the
+    input files are the same (see ModelInputs.with_params), so that repeated
+    calls in one process only read what changed.
+    '''
+    global _inputs
+    if inputs is None:
+        inputs  = ModelInputs(varDict) if _inputs is None else _inputs.with_params(varDict)
+        _inputs = inputs
+    
+    result     = {}
+    returnInfo = actually_run_module(['', varDict, inputs, result])
+    if returnInfo[0] != 0:
+        raise RuntimeError(f"Parcel generation failed:\n{returnInfo[1][1]}")
+    return result
 
-#%%
 
+def serve(varDict, port, host='127.0.0.1'):
+    '''
+    Run the model as a local HTTP service, with the inputs of varDict read once
+    and kept in memory. A POST to /generate with a JSON object of parameters
+    that differ from varDict (e.g. LABEL, Gemeenten_studyarea, PARCELS_PER_HH)
+    runs the model and answers with the KPIs and output paths as JSON (see
+    generate_parcels). Requests are handled one at a time. The inputs of each
+    request are derived from the preloaded inputs (see ModelInputs.with_params),
+    so a request with other input files does not replace them.
+    '''
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    
+    inputs = ModelInputs(varDict).preload()
+    
+    class Handler(BaseHTTPRequestHandler):
+        
+        def do_POST(self):
+            if self.path != '/generate':
+                self.send_error(404)
+                return
+            try:
+                params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or '{}')
+                if not isinstance(params, dict):
+                    raise ValueError("Expected a JSON object with parameters.")
+                requestDict   = dict(varDict, **params)
+                requestInputs = inputs.with_params(requestDict)
+                try:
+                    status, result = 200, generate_parcels(requestDict, inputs=requestInputs)
+                finally:
+                    # Keep what the request read for the preloaded input files (e.g. the distance skim)
+                    inputs.adopt(requestInputs)
+            except ValueError as e:
+                status, result = 400, {'error': str(e)}
+            except Exception as e:
+                status, result = 500, {'error': str(e)}
+            body = json.dumps(result).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    
+    server = HTTPServer((host, port), Handler)
+    print(f'Serving parcel generation on http://{host}:{port}/generate')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
+if __name__ == '__main__':
+    
+    method = 'from_file' #either from_file or from_code
+    
+    # Optional command line options, taken out of sys.argv before the positional arguments are read
+    # --workers N runs the depot choice (for very large numbers of zones and depots, see PARALLEL_MIN_CELLS)
+    # and the C2C distribution in N processes
+    workers = None
+    if '--workers' in sys.argv:
+        i = sys.argv.index('--workers')
+        workers = int(sys.argv[i+1])
+        del sys.argv[i:i+2]
+
+    # --batch FILE runs all scenarios in FILE (see run_batch), --batch-workers N runs N scenarios at the same time
+    batchFile, batchWorkers = None, 1
+    if '--batch' in sys.argv:
+        i = sys.argv.index('--batch')
+        batchFile = sys.argv[i+1]
+        del sys.argv[i:i+2]
+    if '--batch-workers' in sys.argv:
+        i = sys.argv.index('--batch-workers')
+        batchWorkers = int(sys.argv[i+1])
+        del sys.argv[i:i+2]
+    
+    # --serve PORT keeps the model running as a local HTTP service (see serve)
+    servePort = None
+    if '--serve' in sys.argv:
+        i = sys.argv.index('--serve')
+        servePort = int(sys.argv[i+1])
+        del sys.argv[i:i+2]
 
+    args, varDict = generate_args(method)
 
+    if workers is not None:
+        varDict['WORKERS'] = workers
+    
+    if servePort is not None:
+        serve(varDict, servePort)
+        sys.exit()
+    
+    inputs = ModelInputs(varDict)
+    
+    print('Starting Parcel Generation')
+    if batchFile is not None:
+        run_batch(varDict, batchFile, inputs, workers=batchWorkers)
+    else:
+        actually_run_module(args + [inputs])
+    
+    print('Parcel Generation Completed')
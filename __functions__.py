@@ -7,8 +7,18 @@ Created on Thu Oct 22 12:17:13 2020
 import pandas as pd
 import numpy as np
 import shapefile as shp
-import array
 import os.path
+import shutil
+import hashlib
+import json
+import gzip
+import itertools
+import collections
+import struct
+import zlib
+import sys
+import time
+import tracemalloc
 
 def get_traveltime(orig,dest,skim,nZones,timeFac):
     ''' Obtain the travel time [h] for orig to a destination zone. '''
@@ -19,89 +29,851 @@ def get_distance(orig,dest,skim,nZones):
     return skim[(orig-1)*nZones+(dest-1)] / 1000
 
 
+def open_mtx(mtxfile, mode='r'):
+    '''
+    Open a binary mtx-file (skimTijd and skimAfstand) as a memory-mapped
+    (nZones, nZones) int32 array. Nothing is read from disk until the rows
+    are accessed; use mode='c' for a writable copy-on-write view and
+    np.array(...) to materialise the full matrix.
+    A skim in the tiled format (see write_tiled_mtx) is opened as a TiledSkim,
+    or read completely into a writable array with mode='c'.
+    '''
+    if is_tiled_mtx(mtxfile):
+        if mode == 'r':
+            return TiledSkim(mtxfile)
+        if mode == 'c':
+            return np.asarray(TiledSkim(mtxfile))
+        raise ValueError(f"{mtxfile} is a tiled skim, which can only be opened with mode 'r' or 'c'.")
+    
+    nValues = os.path.getsize(mtxfile) // 4
+    
+    # The number of zones is in the first value
+    nZones = int(np.fromfile(mtxfile, dtype=np.int32, count=1)[0])
+    if nZones * nZones != nValues - 1:
+        nZones = int(round((nValues - 1)**0.5))
+        if nZones * nZones != nValues - 1:
+            raise ValueError(f"{mtxfile} does not contain a square skim matrix.")
+    
+    return np.memmap(mtxfile, dtype=np.int32, mode=mode, offset=4, shape=(nZones, nZones))
+
+
 def read_mtx(mtxfile):  
     '''
-    Read a binary mtx-file (skimTijd and skimAfstand)
+    Read a binary mtx-file (skimTijd and skimAfstand) as a flat array
+    (copy-on-write view on the file, see open_mtx)
+    '''
+    return open_mtx(mtxfile, mode='c').reshape(-1)
+
+
+def write_mtx(mtxfile, skim):
+    '''
+    Write a 2D skim to a binary mtx-file, with the number of zones in the first value
+    '''
+    with open(mtxfile, 'wb') as f:
+        np.array([skim.shape[0]], dtype=np.int32).tofile(f)
+        np.asarray(skim, dtype=np.int32).tofile(f)
+
+
+def intrazonal_values(rows, factor=0.7):
+    '''
+    Intrazonal values of a block of skim rows (2D): factor times the lowest
+    positive value in each row, and whether the row has a positive value
+    '''
+    rowMin = np.where(rows > 0, rows, np.inf).min(axis=1)
+    hasMin = np.isfinite(rowMin)
+    return factor * np.where(hasMin, rowMin, 0), hasMin
+
+
+def fill_intrazonal(skim, factor=0.7, chunkSize=512):
+    '''
+    Set the intrazonal values (diagonal) of a 2D skim to factor times the lowest
+    positive value in the row (see intrazonal_values), processing chunkSize rows
+    at a time. Rows without positive values are left unchanged.
+    '''
+    nZones = skim.shape[0]
+    for start in range(0, nZones, chunkSize):
+        rows   = np.arange(start, min(start+chunkSize, nZones))
+        values, hasMin = intrazonal_values(np.asarray(skim[rows[0]:rows[-1]+1]), factor)
+        skim[rows[hasMin], rows[hasMin]] = values[hasMin]
+    return skim
+
+
+def read_mtx_intrazonal(mtxfile, deficientZones=(), deficientValue=5000, factor=0.7, cache=None):
+    '''
+    Open a binary mtx-file with intrazonal values added (see fill_intrazonal) and
+    with the rows and columns of deficientZones (skim indices, starting at 0) set
+    to deficientValue. Without cache the skim is patched in memory (a
+    copy-on-write view, so only the patched pages are copied). With cache (an
+    InputCache) the result is stored there as an mtx-file, keyed by the content
+    of mtxfile and the settings, and evicted like the other cache entries.
     '''
-    mtxData = array.array('i')  # i for integer
-    mtxData.fromfile(open(mtxfile, 'rb'), os.path.getsize(mtxfile) // mtxData.itemsize)
+    deficientZones = sorted(int(zone) for zone in deficientZones)
+    nZones = open_mtx(mtxfile).shape[0]
+    if deficientZones and not (0 <= deficientZones[0] and deficientZones[-1] < nZones):
+        raise ValueError(f"Deficient zones {deficientZones} are not all in the {nZones} zones of {mtxfile}.")
     
-    # The number of zones is in the first byte
-    mtxData = np.array(mtxData, dtype=int)[1:]
+    def patch(skim):
+        for zone in deficientZones:
+            skim[zone] = skim[:,zone] = deficientValue
+        return fill_intrazonal(skim, factor)
     
-    return mtxData
+    if cache is None:
+        return patch(open_mtx(mtxfile, mode='c'))
+    
+    stem      = os.path.splitext(os.path.basename(mtxfile))[0]
+    cacheFile = cache.entry_path(f"{stem}_intrazonal", [mtxfile], suffix='.mtx',
+                                 settings=[deficientZones, deficientValue, factor])
+    if os.path.isfile(cacheFile):
+        os.utime(cacheFile)
+        return open_mtx(cacheFile)
+    
+    tmpFile = f"{cacheFile}.{os.getpid()}.tmp"
+    if is_tiled_mtx(mtxfile):
+        # Patched in memory and written in the tiled format of mtxfile
+        source = TiledSkim(mtxfile)
+        write_tiled_mtx(tmpFile, patch(np.asarray(source)), tileRows=source.tileRows,
+                        scale=source.scale if source.quantized else None)
+    else:
+        shutil.copyfile(mtxfile, tmpFile)
+        skim = patch(open_mtx(tmpFile, mode='r+'))
+        skim.flush()
+        del skim
+    os.replace(tmpFile, cacheFile)
+    cache.evict(keep=cacheFile)
+    return open_mtx(cacheFile)
 
 
+TILED_MTX_MAGIC  = b'PGTSKIM1'
+TILED_MTX_HEADER = struct.Struct('<8sqqqd')   # magic, nZones, tileRows, quantized, scale
 
-def read_shape(shapePath, encoding='latin1', returnGeometry=False):
+def is_tiled_mtx(mtxfile):
     '''
-    Read the shapefile with zones (using pyshp --> import shapefile as shp)
+    Whether mtxfile is a skim in the tiled format (see write_tiled_mtx)
     '''
-    # Load the shape
-    sf = shp.Reader(shapePath, encoding=encoding)
-    records = sf.records()
-    if returnGeometry:
-        geometry = sf.__geo_interface__
-        geometry = geometry['features']
-        geometry = [geometry[i]['geometry'] for i in range(len(geometry))]
-    fields = sf.fields
-    sf.close()
+    with open(mtxfile, 'rb') as f:
+        return f.read(len(TILED_MTX_MAGIC)) == TILED_MTX_MAGIC
+
+
+def write_tiled_mtx(mtxfile, skim, tileRows=256, scale=None, level=6):
+    '''
+    Write a 2D skim (e.g. from open_mtx) in the tiled format: blocks of tileRows
+    rows, each compressed separately (zlib), after a header and an index of the
+    file offsets of the tiles, so that readers only decompress the tiles with
+    the rows they need (see TiledSkim). With scale, the values are quantized to
+    uint16 multiples of scale (e.g. scale=1 for seconds or metres up to 65535,
+    scale=10 for up to 655350); values out of that range raise a ValueError.
+    '''
+    nZones = skim.shape[0]
+    nTiles = -(-nZones // tileRows)
     
-    # Get information on the fields in the DBF
-    columns  = [x[0] for x in fields[1:]]
-    colTypes = [x[1:] for x in fields[1:]]
-    nRecords = len(records)
-    
-    # Put all the data records into a NumPy array (much faster than Pandas DataFrame)
-    shape = np.zeros((nRecords,len(columns)), dtype=object)
-    for i in range(nRecords):
-        shape[i,:] = records[i][0:]
-    
-    # Then put this into a Pandas DataFrame with the right headers and data types
-    shape = pd.DataFrame(shape, columns=columns)
-    for col in range(len(columns)):
-        if colTypes[col][0] == 'C':
-            shape[columns[col]] = shape[columns[col]].astype(str)
-        else:
-            shape.loc[pd.isna(shape[columns[col]]), columns[col]] = -99999
-            if colTypes[col][-1] > 0:
-                shape[columns[col]] = shape[columns[col]].astype(float)
+    with open(mtxfile, 'wb') as f:
+        f.write(TILED_MTX_HEADER.pack(TILED_MTX_MAGIC, nZones, tileRows, scale is not None, scale or 1.0))
+        indexPos = f.tell()
+        offsets  = np.zeros(nTiles + 1, dtype='<u8')
+        f.write(offsets.tobytes())
+        
+        for t in range(nTiles):
+            block = np.asarray(skim[t*tileRows:(t+1)*tileRows])
+            if scale is None:
+                block = block.astype('<i4')
             else:
-                shape[columns[col]] = shape[columns[col]].astype(int)
+                block = np.round(block / scale)
+                if block.min() < 0 or block.max() > np.iinfo(np.uint16).max:
+                    raise ValueError(f"Skim values do not fit in uint16 with scale {scale}.")
+                block = block.astype('<u2')
+            offsets[t] = f.tell()
+            f.write(zlib.compress(block.tobytes(), level))
+        offsets[nTiles] = f.tell()
+        
+        f.seek(indexPos)
+        f.write(offsets.tobytes())
+
+
+class TiledSkim:
+    '''
+    Read-only (nZones, nZones) int32 skim in the tiled format (see
+    write_tiled_mtx), used like the memory-mapped skim of open_mtx. Indexing
+    (skim[i], skim[rows], skim[rows, cols], skim[np.ix_(rows, cols)], slices)
+    reads and decompresses only the tiles with the requested rows; the last
+    cacheTiles decompressed tiles are kept in memory. np.asarray(skim) reads
+    the full matrix.
+    '''
+    
+    ndim = 2
+    
+    def __init__(self, mtxfile, cacheTiles=16):
+        self.mtxfile = mtxfile
+        with open(mtxfile, 'rb') as f:
+            magic, nZones, tileRows, quantized, scale = TILED_MTX_HEADER.unpack(f.read(TILED_MTX_HEADER.size))
+            if magic != TILED_MTX_MAGIC:
+                raise ValueError(f"{mtxfile} is not a tiled skim.")
+            nTiles = -(-nZones // tileRows)
+            self.offsets = np.frombuffer(f.read(8 * (nTiles + 1)), dtype='<u8')
+        self.shape      = (nZones, nZones)
+        self.dtype      = np.dtype(np.int32)
+        self.tileRows   = tileRows
+        self.quantized  = bool(quantized)
+        self.scale      = scale
+        self.cacheTiles = cacheTiles
+        self.tiles      = collections.OrderedDict()
+    
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    
+    def tile(self, t):
+        ''' The rows of tile t as an int32 array '''
+        if t in self.tiles:
+            self.tiles.move_to_end(t)
+            return self.tiles[t]
+        with open(self.mtxfile, 'rb') as f:
+            f.seek(int(self.offsets[t]))
+            data = zlib.decompress(f.read(int(self.offsets[t+1] - self.offsets[t])))
+        if self.quantized:
+            values = np.frombuffer(data, dtype='<u2').reshape(-1, self.shape[1])
+            values = np.round(values * self.scale).astype(np.int32)
+        else:
+            values = np.frombuffer(data, dtype='<i4').reshape(-1, self.shape[1]).astype(np.int32)
+        self.tiles[t] = values
+        if len(self.tiles) > self.cacheTiles:
+            self.tiles.popitem(last=False)
+        return values
+    
+    
+    def rows(self, rows):
+        ''' The given rows (indices, starting at 0, or a boolean mask) as a (len(rows), nZones) array '''
+        rows   = np.asarray(rows)
+        rows   = np.arange(self.shape[0])[rows if rows.dtype == bool else rows.astype(int)]
+        result = np.empty((len(rows), self.shape[1]), dtype=np.int32)
+        tiles  = rows // self.tileRows
+        for t in np.unique(tiles):
+            which = (tiles == t)
+            result[which] = self.tile(t)[rows[which] - t * self.tileRows]
+        return result
+    
+    
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        rowKey = key[0]
+        colKey = key[1] if len(key) > 1 else slice(None)
+        if isinstance(rowKey, slice):
+            return self.rows(np.arange(self.shape[0])[rowKey])[:, colKey]
+        rowKey = np.asarray(rowKey)
+        if rowKey.ndim == 0:
+            return self.rows(rowKey.reshape(1))[0, colKey]
+        if rowKey.ndim == 2:
+            # np.ix_(rows, cols)
+            return self.rows(rowKey.ravel())[:, np.asarray(colKey).ravel()]
+        return self.rows(rowKey)[:, colKey]
+    
+    
+    def __array__(self, dtype=None, copy=None):
+        values = self.rows(np.arange(self.shape[0]))
+        return values if dtype is None else values.astype(dtype)
+
+
+def skim_columns(skim, origs, factor=None, dtype=np.float32, dests=None):
+    '''
+    Gather the skim rows of the given origins (skim numbers, starting at 1) in
+    one read and return them as a (nZones, len(origs)) matrix, one column per
+    origin. The values are multiplied by factor (e.g. 1/3600 for hours or
+    1/1000 for kilometers) and stored as dtype; with factor=None the int32
+    values of the skim are returned unscaled.
+    With dests (skim numbers), only the cells of those destinations are read
+    from the skim and the result has one row per destination, in that order.
+    '''
+    origs   = np.asarray(origs, dtype=int)
+    if dests is None:
+        columns = skim[origs-1,:].T
+    else:
+        columns = skim[np.ix_(origs-1, np.asarray(dests, dtype=int)-1)].T
+    if factor is None:
+        return np.asarray(columns)
+    columns = columns.astype(dtype)
+    columns *= factor
+    return columns
+
+
+def skim_pairs(skim, origs, dests, factor=None, dtype=np.float32, chunkSize=256, intrazonal=None):
+    '''
+    Skim values of the OD pairs origs[i] to dests[i] (skim numbers, starting at
+    1). Only the rows of the distinct origins are read, chunkSize rows at a
+    time. With intrazonal (a factor, e.g. 0.7), the pairs with origs[i] ==
+    dests[i] get the intrazonal value of their row (see intrazonal_values)
+    instead of the value on the diagonal. The values are multiplied by factor
+    and stored as dtype, as in skim_columns.
+    '''
+    origs   = np.asarray(origs, dtype=int)
+    dests   = np.asarray(dests, dtype=int)
+    values  = np.zeros(len(origs), dtype=np.float64)
+    
+    uniqueOrigs, origPos = np.unique(origs, return_inverse=True)
+    order  = np.argsort(origPos, kind='stable')
+    starts = range(0, len(uniqueOrigs), chunkSize)
+    bounds = np.searchsorted(origPos[order], list(starts) + [len(uniqueOrigs)])
+    
+    for start, first, last in zip(starts, bounds[:-1], bounds[1:]):
+        block = np.asarray(skim[uniqueOrigs[start:start+chunkSize]-1])
+        pairs = order[first:last]
+        rows  = origPos[pairs] - start
+        values[pairs] = block[rows, dests[pairs]-1]
+        if intrazonal is not None:
+            same = (origs[pairs] == dests[pairs])
+            intrazonalRows, hasMin = intrazonal_values(block[rows[same]], intrazonal)
+            values[pairs[same][hasMin]] = intrazonalRows[hasMin]
+    
+    if factor is not None:
+        values *= factor
+    return values.astype(dtype)
+
+
+
+def read_dbf(dbfPath, encoding='latin1'):
+    '''
+    Read a DBF table column by column into a DataFrame. Character fields become
+    strings, numeric fields floats (with decimals) or ints (without decimals),
+    and missing numbers are set to -99999. Deleted records are skipped.
+    '''
+    data = np.fromfile(dbfPath, dtype=np.uint8)
+    nRecords  = int(data[4:8].view('<u4')[0])
+    headerLen = int(data[8:10].view('<u2')[0])
+    
+    # Field descriptors of 32 bytes each, ended by a carriage return
+    fields = []
+    for pos in range(32, headerLen - 1, 32):
+        if data[pos] == 0x0D:
+            break
+        desc = data[pos:pos+32].tobytes()
+        name = desc[:11].split(b'\x00')[0].decode(encoding).strip()
+        fields.append((name, chr(desc[11]), desc[16], desc[17]))
+    
+    recDtype = np.dtype([('DeletionFlag', 'S1')] + [(f'f{i}', f'S{size}') for i, (_, _, size, _) in enumerate(fields)])
+    nRecords = min(nRecords, (len(data) - headerLen) // recDtype.itemsize)
+    records  = np.frombuffer(data, dtype=recDtype, count=nRecords, offset=headerLen)
+    records  = records[records['DeletionFlag'] != b'*']
+    
+    shape = {}
+    for i, (name, colType, size, decimal) in enumerate(fields):
+        values = np.char.strip(records[f'f{i}'])
+        
+        if colType in ('N', 'F'):
+            values  = np.char.replace(values, b'*', b'') # QGIS NULL is all '*' chars
+            missing = (values == b'')
+            values  = np.where(missing, b'-99999', values)
+            try:
+                column = values.astype(float if decimal > 0 else np.int64)
+            except ValueError:
+                column = np.array([_parse_number(value) for value in values], dtype=float)
+                column[np.isnan(column)] = -99999
+                if decimal == 0:
+                    column = column.astype(np.int64)
+        
+        elif colType == 'L':
+            column = np.full(len(values), -99999, dtype=np.int64)
+            column[np.isin(values, [b'Y', b'y', b'T', b't', b'1'])] = 1
+            column[np.isin(values, [b'N', b'n', b'F', b'f', b'0'])] = 0
+        
+        else:
+            column = np.char.decode(values, encoding).astype(object)
+        
+        shape[name] = column
+    
+    return pd.DataFrame(shape)
+
+
+def _parse_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def read_points(shapePath):
+    '''
+    Read the X and Y coordinates of a point shapefile into two float arrays,
+    straight from the records in the SHP file
+    '''
+    data = np.fromfile(shapePath, dtype=np.uint8)
+    shapeType = int(data[32:36].view('<i4')[0])
+    
+    # Each point record: record header (big-endian), shape type, X and Y
+    pointDtype = np.dtype([('recNo', '>i4'), ('length', '>i4'), ('type', '<i4'), ('X', '<f8'), ('Y', '<f8')])
+    if shapeType == 1 and (len(data) - 100) % pointDtype.itemsize == 0:
+        points = np.frombuffer(data, dtype=pointDtype, offset=100)
+        if np.all(points['type'] == 1):
+            return points['X'].copy(), points['Y'].copy()
+    
+    # Null shapes or PointZ/PointM records: let pyshp read them
+    sf = shp.Reader(shapePath)
+    points = [shape.points[0] if shape.points else (np.nan, np.nan) for shape in sf.shapes()]
+    sf.close()
+    points = np.array(points, dtype=float).reshape(-1, 2)
+    return points[:,0], points[:,1]
+
+
+def read_shape(shapePath, encoding='latin1', returnGeometry=False):
+    '''
+    Read the attribute table of a shapefile (see read_dbf), and optionally the
+    geometry of each record as a GeoJSON-like dict (using pyshp)
+    '''
+    dbfPath = os.path.splitext(shapePath)[0] + '.dbf'
+    if not os.path.isfile(dbfPath):
+        dbfPath = os.path.splitext(shapePath)[0] + '.DBF'
+    shape = read_dbf(dbfPath, encoding=encoding)
     
     if returnGeometry:
+        sf = shp.Reader(shapePath, encoding=encoding)
+        geometry = [feature['geometry'] for feature in sf.__geo_interface__['features']]
+        sf.close()
         return (shape, geometry)
     else:
         return shape
 
-def create_geojson(output_path, DataFrame, origin_x, origin_y, destination_x, destination_y)    :
-    #----- GeoJSON ---
-    # print('Writing GeoJSON...') 
-    Ax = np.array(DataFrame[origin_x], dtype=str)
-    Ay = np.array(DataFrame[origin_y], dtype=str)
-    Bx = np.array(DataFrame[destination_x], dtype=str)
-    By = np.array(DataFrame[destination_y], dtype=str)
-    nTrips = len(DataFrame.index)
+def create_geojson(output_path, DataFrame, origin_x, origin_y, destination_x, destination_y, properties=None, chunkSize=100000):
+    '''
+    Write each row of DataFrame as a GeoJSON LineString feature from
+    (origin_x, origin_y) to (destination_x, destination_y), with the columns in
+    properties (default: all columns) as its properties. The features are
+    formatted chunkSize rows at a time from the column arrays and streamed to
+    the file; an output_path ending with '.gz' is written gzip-compressed.
+    DataFrame can also be an iterable of DataFrames, written as they come.
+    '''
+    if isinstance(DataFrame, pd.DataFrame):
+        batches = [DataFrame]
+    else:
+        batches = iter(DataFrame)
+        DataFrame = next(batches, None)
+        if DataFrame is None:
+            raise ValueError("No batches to write.")
+        batches = itertools.chain([DataFrame], batches)
+    
+    if properties is None:
+        properties = list(DataFrame.columns)
+    featureFormat = ('{ "type": "Feature", "properties": { ' +
+                     ', '.join(json.dumps(str(col)).replace('%', '%%') + ': %s' for col in properties) +
+                     ' }, "geometry": { "type": "LineString", "coordinates": [ [ %s, %s ], [ %s, %s ] ] } }')
+    columnNames = list(properties) + [origin_x, origin_y, destination_x, destination_y]
+    
+    if output_path.endswith('.gz'):
+        geoFile = gzip.open(output_path, 'wt', encoding='utf-8')
+    else:
+        geoFile = open(output_path, 'w', encoding='utf-8', buffering=2**20)
     
-    with open(output_path, 'w') as geoFile:
+    with geoFile:
         geoFile.write('{\n' + '"type": "FeatureCollection",\n' + '"features": [\n')
-        for i in range(nTrips-1):
-            outputStr = ""
-            outputStr = outputStr + '{ "type": "Feature", "properties": '
-            outputStr = outputStr + str(DataFrame.loc[i,:].to_dict()).replace("'",'"')
-            outputStr = outputStr + ', "geometry": { "type": "LineString", "coordinates": [ [ '
-            outputStr = outputStr + Ax[i] + ', ' + Ay[i] + ' ], [ '
-            outputStr = outputStr + Bx[i] + ', ' + By[i] + ' ] ] } },\n'
-            geoFile.write(outputStr)
-                
-        # Bij de laatste feature moet er geen komma aan het einde
-        i += 1
-        outputStr = ""
-        outputStr = outputStr + '{ "type": "Feature", "properties": '
-        outputStr = outputStr + str(DataFrame.loc[i,:].to_dict()).replace("'",'"')
-        outputStr = outputStr + ', "geometry": { "type": "LineString", "coordinates": [ [ '
-        outputStr = outputStr + Ax[i] + ', ' + Ay[i] + ' ], [ '
-        outputStr = outputStr + Bx[i] + ', ' + By[i] + ' ] ] } }\n'
-        geoFile.write(outputStr)
-        geoFile.write(']\n')
-        geoFile.write('}')
\ No newline at end of file
+        first = True
+        for batch in batches:
+            columns = [np.asarray(batch[col]) for col in columnNames]
+            for start in range(0, len(batch.index), chunkSize):
+                values = [_json_values(col[start:start+chunkSize]) for col in columns]
+                if not first:
+                    geoFile.write(',\n')
+                geoFile.write(',\n'.join(featureFormat % row for row in zip(*values)))
+                first = False
+        geoFile.write('\n]\n')
+        geoFile.write('}\n')
+
+
+def _json_values(values):
+    '''
+    Format an array of values as a list of JSON values
+    '''
+    if values.dtype.kind in 'iu':
+        return values.astype(str).tolist()
+    if values.dtype.kind == 'b':
+        return np.where(values, 'true', 'false').tolist()
+    if values.dtype.kind == 'f':
+        text = values.astype(str)
+        text[~np.isfinite(values)] = 'null'
+        return text.tolist()
+    return [_json_value(value) for value in values]
+
+
+def _json_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return 'null'
+    return json.dumps(value, default=str)
+
+
+def _import_pyarrow():
+    ''' pyarrow and pyarrow.parquet, an optional requirement for Parquet and Feather files '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Parquet and Feather files require pyarrow (see requirements.txt).") from e
+    return pa, pq
+
+
+def write_columnar(output_path, DataFrame, fileFormat='parquet', compression=None, chunkSize=1000000, categories=None):
+    '''
+    Write DataFrame to a typed columnar file: 'parquet' or 'feather' (Arrow
+    IPC). Integer columns are stored as int32 when their values fit and text
+    columns as dictionary-encoded categories. The rows are written in chunks of
+    chunkSize (one row group or record batch each), with optional compression
+    ('snappy', 'lz4', 'zstd'; None for uncompressed). Requires pyarrow.
+    
+    DataFrame can also be an iterable of DataFrames with the same columns,
+    which are then written one by one as they come. The column types follow
+    the first batch, and the text values of all batches must be in the
+    categories of that batch, unless given in categories (column --> values).
+    '''
+    pa, pq = _import_pyarrow()
+    
+    if isinstance(DataFrame, pd.DataFrame):
+        first   = DataFrame
+        batches = (DataFrame.iloc[start:start+chunkSize] for start in range(0, len(DataFrame), chunkSize))
+    else:
+        batches = iter(DataFrame)
+        first   = next(batches, None)
+        if first is None:
+            raise ValueError("No batches to write.")
+        batches = itertools.chain([first], batches)
+    
+    # Column types, based on the whole DataFrame or the first batch
+    int32Cols  = []
+    categories = dict(categories or {})
+    for col in first.columns:
+        values = np.asarray(first[col])
+        if values.dtype.kind in 'iu' and len(values) > 0 and \
+                np.iinfo(np.int32).min <= values.min() and values.max() <= np.iinfo(np.int32).max:
+            int32Cols.append(col)
+        elif values.dtype.kind in 'OU' and col not in categories:
+            categories[col] = pd.unique(values[pd.notna(values)])
+    
+    schema = pa.Schema.from_pandas(_typed_columns(first.iloc[:0], int32Cols, categories), preserve_index=False)
+    if fileFormat == 'parquet':
+        writer = pq.ParquetWriter(output_path, schema, compression=compression or 'none')
+    elif fileFormat == 'feather':
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        writer = pa.ipc.new_file(output_path, schema, options=options)
+    else:
+        raise ValueError(f"Unknown columnar file format: {fileFormat}")
+    
+    with writer:
+        for batch in batches:
+            for start in range(0, len(batch), chunkSize):
+                chunk = _typed_columns(batch.iloc[start:start+chunkSize], int32Cols, categories)
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+def _typed_columns(DataFrame, int32Cols, categories):
+    '''
+    Convert the columns in int32Cols to int32 and the columns in categories to
+    categoricals with those categories
+    '''
+    columns = {}
+    for col in DataFrame.columns:
+        values = np.asarray(DataFrame[col])
+        if col in int32Cols:
+            if len(values) > 0 and (values.min() < np.iinfo(np.int32).min or values.max() > np.iinfo(np.int32).max):
+                raise ValueError(f"Values of column {col} do not fit in int32.")
+            columns[col] = values.astype(np.int32)
+        elif col in categories:
+            columns[col] = pd.Categorical(values, categories=categories[col])
+            if np.any((columns[col].codes == -1) & pd.notna(values)):
+                raise ValueError(f"Column {col} has values that are not in its categories.")
+        else:
+            columns[col] = values
+    return pd.DataFrame(columns)
+
+
+def read_columnar(path, asTable=False):
+    '''
+    Read a file written with write_columnar into a DataFrame (or a pyarrow
+    Table with asTable=True). Feather files are memory-mapped, so an
+    uncompressed Table is read without copying.
+    '''
+    pa, pq = _import_pyarrow()
+    
+    if path.endswith('.parquet'):
+        table = pq.read_table(path, memory_map=True)
+    else:
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    
+    if asTable:
+        return table
+    return table.to_pandas()
+
+
+class ZoneIndex:
+    '''
+    Translation between zone numbers (AREANR) and skim numbers (1 to nZones),
+    with the coordinates of each zone. Skim numbers follow the order of the
+    areanr array: the internal zones sorted by AREANR, then the external zones.
+    All lookups take and return arrays.
+    '''
+    
+    def __init__(self, areanr, x, y):
+        self.areanr = np.ascontiguousarray(areanr, dtype=np.int64)
+        self.x      = np.ascontiguousarray(x, dtype=float)
+        self.y      = np.ascontiguousarray(y, dtype=float)
+        self.order  = np.argsort(self.areanr, kind='stable')
+        self.sortedAreanr = self.areanr[self.order]
+    
+    
+    @classmethod
+    def from_zones(cls, zones, supCoordinates):
+        '''
+        Build the index from the zones (columns AREANR, X, Y) and the external
+        zones (columns AREANR, Xcoor, Ycoor)
+        '''
+        intOrder = np.argsort(np.asarray(zones['AREANR']), kind='stable')
+        supOrder = np.argsort(np.asarray(supCoordinates['AREANR']), kind='stable')
+        return cls(np.concatenate([np.asarray(zones['AREANR'])[intOrder], np.asarray(supCoordinates['AREANR'])[supOrder]]),
+                   np.concatenate([np.asarray(zones['X'])[intOrder],      np.asarray(supCoordinates['Xcoor'])[supOrder]]),
+                   np.concatenate([np.asarray(zones['Y'])[intOrder],      np.asarray(supCoordinates['Ycoor'])[supOrder]]))
+    
+    
+    def __len__(self):
+        return len(self.areanr)
+    
+    
+    def skim_numbers(self, areanr):
+        ''' Skim numbers (starting at 1) of an array of zone numbers '''
+        areanr = np.asarray(areanr, dtype=np.int64)
+        pos    = np.searchsorted(self.sortedAreanr, areanr)
+        pos    = np.minimum(pos, len(self) - 1)
+        found  = (self.sortedAreanr[pos] == areanr)
+        if not np.all(found):
+            raise KeyError(f"Unknown zones: {np.unique(areanr[~found])[:10].tolist()}")
+        return self.order[pos] + 1
+    
+    
+    def zone_numbers(self, skimNrs):
+        ''' Zone numbers (AREANR) of an array of skim numbers '''
+        return self.areanr[np.asarray(skimNrs, dtype=int) - 1]
+    
+    
+    def coordinates(self, areanr):
+        ''' X and Y coordinates of an array of zone numbers '''
+        index = self.skim_numbers(areanr) - 1
+        return self.x[index], self.y[index]
+
+
+class InputCache:
+    '''
+    On-disk cache (.npz and .mtx files in cacheFolder) of inputs derived from files.
+    Entries are keyed by the paths, sizes, modification times and content
+    hashes of the files they were derived from, so they are invalidated
+    automatically when a file changes. The least recently used entries are
+    removed when the cache grows beyond maxSize bytes.
+    '''
+    
+    def __init__(self, cacheFolder, maxSize=2*1024**3):
+        self.cacheFolder = cacheFolder
+        self.maxSize     = maxSize
+        self.hashFile    = os.path.join(cacheFolder, 'hashes.json')
+        os.makedirs(cacheFolder, exist_ok=True)
+        try:
+            with open(self.hashFile) as f:
+                self.hashes = json.load(f)
+        except (OSError, ValueError):
+            self.hashes = {}
+    
+    
+    def get(self, name, paths, build):
+        '''
+        Return the cached value of build() for the given input files, building
+        and storing it if there is no valid entry.
+        '''
+        cacheFile = self.entry_path(name, paths)
+        if os.path.isfile(cacheFile):
+            try:
+                value = _load_npz(cacheFile)
+                os.utime(cacheFile)
+                return value
+            except (OSError, ValueError, KeyError):
+                pass
+        
+        value = build()
+        _save_npz(cacheFile, value)
+        self.evict(keep=cacheFile)
+        return value
+    
+    
+    def entry_path(self, name, paths, suffix='.npz', settings=None):
+        '''
+        Path of the cache entry of name for the given input files, and for the
+        settings (JSON-serializable) it was derived with, if any
+        '''
+        keyName = name if settings is None else name + json.dumps(settings)
+        return os.path.join(self.cacheFolder, f"{name}_{self.key(keyName, paths)}{suffix}")
+    
+    
+    def key(self, name, paths):
+        ''' Hash of name and the signatures of the files in paths '''
+        key = hashlib.sha1(name.encode())
+        for path in paths:
+            key.update(path.encode())
+            key.update(self.file_hash(path).encode())
+        return key.hexdigest()[:16]
+    
+    
+    def file_hash(self, path):
+        '''
+        Content hash of a file. It is only recomputed when the size or
+        modification time of the file differ from when it was last hashed.
+        '''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self.hashes.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        
+        contentHash = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**24), b''):
+                contentHash.update(block)
+        self.hashes[path] = [stat.st_size, stat.st_mtime_ns, contentHash.hexdigest()]
+        
+        tmpFile = f"{self.hashFile}.{os.getpid()}.tmp"
+        with open(tmpFile, 'w') as f:
+            json.dump(self.hashes, f)
+        os.replace(tmpFile, self.hashFile)
+        return self.hashes[path][2]
+    
+    
+    def evict(self, keep=None):
+        ''' Remove the least recently used entries until the cache fits in maxSize '''
+        entries = [os.path.join(self.cacheFolder, file) for file in os.listdir(self.cacheFolder) if file.endswith(('.npz', '.mtx'))]
+        entries = sorted(entries, key=os.path.getmtime)
+        totalSize = sum(os.path.getsize(file) for file in entries)
+        for file in entries:
+            if totalSize <= self.maxSize:
+                break
+            if file != keep:
+                try:
+                    totalSize -= os.path.getsize(file)
+                    os.remove(file)
+                except OSError:
+                    pass
+
+
+def _save_npz(path, value):
+    '''
+    Store a DataFrame, array or dict (with scalar or array values) in an npz-file
+    '''
+    if isinstance(value, pd.DataFrame):
+        arrays = {'kind': 'frame', 'columns': np.array(value.columns), 
+                  'index': np.asarray(value.index), 'indexName': np.array(value.index.name, dtype=object)}
+        for i, col in enumerate(value.columns):
+            arrays[f'c{i}'] = np.asarray(value[col])
+    elif isinstance(value, dict):
+        arrays = {'kind': 'dict', 'keys': np.array(list(value.keys()))}
+        values = list(value.values())
+        if all(np.isscalar(v) for v in values):
+            arrays['values'] = np.array(values)
+        else:
+            for i, v in enumerate(values):
+                arrays[f'v{i}'] = np.asarray(v)
+    else:
+        arrays = {'kind': 'array', 'array': np.asarray(value)}
+    
+    tmpFile = f"{path}.{os.getpid()}.tmp"
+    with open(tmpFile, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmpFile, path)
+
+
+def _load_npz(path):
+    '''
+    Load a value stored with _save_npz
+    '''
+    with np.load(path, allow_pickle=True) as arrays:
+        kind = str(arrays['kind'])
+        if kind == 'frame':
+            columns = arrays['columns'].tolist()
+            value = pd.DataFrame({col: arrays[f'c{i}'] for i, col in enumerate(columns)}, columns=columns)
+            value.index = pd.Index(arrays['index'], name=arrays['indexName'].item())
+        elif kind == 'dict':
+            keys = arrays['keys'].tolist()
+            if 'values' in arrays:
+                value = dict(zip(keys, arrays['values'].tolist()))
+            else:
+                value = {key: arrays[f'v{i}'] for i, key in enumerate(keys)}
+        else:
+            value = arrays['array']
+    return value
+
+
+class StageProfiler:
+    '''
+    Record the wall time, CPU time and peak memory of the consecutive stages of
+    a run: stage(name) ends the current stage and starts the next one, stop()
+    ends the last one. Stages with the same name are added up. The peak memory
+    is the peak resident set size of the process so far (not available on
+    Windows) and, with traceMemory, the peak of the memory allocated by Python
+    during the stage (tracemalloc; before Python 3.9, which cannot reset the
+    peak, the peak since the profiler started). close() stops tracemalloc if
+    the profiler started it.
+    '''
+    
+    def __init__(self, traceMemory=False):
+        self.stages      = {}
+        self.current     = None
+        self.traceMemory = traceMemory
+        self.startedTracing = traceMemory and not tracemalloc.is_tracing()
+        if self.startedTracing:
+            tracemalloc.start()
+    
+    
+    def stage(self, name):
+        ''' End the current stage and start stage name '''
+        self.stop()
+        if self.traceMemory and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.current = (name, time.perf_counter(), time.process_time())
+    
+    
+    def stop(self):
+        ''' End the current stage '''
+        if self.current is None:
+            return
+        name, wallStart, cpuStart = self.current
+        self.current = None
+        
+        record = self.stages.setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0})
+        record['wall_s'] += time.perf_counter() - wallStart
+        record['cpu_s']  += time.process_time() - cpuStart
+        record['peak_rss_mb'] = _peak_rss_mb()
+        if self.traceMemory:
+            peak = tracemalloc.get_traced_memory()[1] / 1024**2
+            record['peak_traced_mb'] = max(peak, record.get('peak_traced_mb', 0.0))
+    
+    
+    def close(self):
+        ''' End the current stage and stop tracemalloc if this profiler started it '''
+        self.stop()
+        if self.startedTracing:
+            tracemalloc.stop()
+            self.startedTracing = False
+    
+    
+    def report(self):
+        ''' The recorded stages and their totals, as a dict that can be written to JSON '''
+        self.close()
+        stages = {name: {key: round(value, 4) if value is not None else None for key, value in record.items()}
+                  for name, record in self.stages.items()}
+        total  = {'wall_s': round(sum(record['wall_s'] for record in self.stages.values()), 4),
+                  'cpu_s':  round(sum(record['cpu_s'] for record in self.stages.values()), 4),
+                  'peak_rss_mb': _peak_rss_mb()}
+        return {'stages': stages, 'total': total}
+
+
+def _peak_rss_mb():
+    '''
+    Peak resident set size of this process in MB, or None where the resource
+    module is not available (Windows)
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return round(peak / 1024**2 if sys.platform == 'darwin' else peak / 1024, 1)
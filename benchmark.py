@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the parcel generator on synthetic inputs
+
+Synthesizes zones, SEGS, parcel nodes, courier shares and .mtx skims at one or
+more scales (number of zones, depots and couriers), runs the model on each with
+stage profiling (see StageProfiler) and appends the results, with the current
+git commit, to a JSON lines file, so that runs of different commits can be
+compared. Each model run has a fresh process, so that its peak memory does
+not include making the inputs or the runs of other scales. For example:
+
+    python benchmark.py --scale 1000 10 1 --scale 20000 1000 20 --label UCC
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import shapefile as shp
+
+
+DEFAULT_SCALES = [(1000, 10, 1), (5000, 100, 5), (20000, 1000, 20)]
+N_EXTERNAL     = 43
+ZONES_PER_GEM  = 100
+
+
+def make_inputs(folder, nZones, nDepots, nCEP, seed=1, chunkSize=256):
+    '''
+    Write a synthetic set of model inputs with nZones internal zones, nDepots
+    parcel depots and nCEP couriers to folder. Returns the varDict entries of
+    the input files and the municipalities of the study area.
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+
+    # Zones on a square of about 5 zones per km, with municipalities of ZONES_PER_GEM zones
+    side    = np.sqrt(nZones) * 200
+    areanr  = np.arange(1, nZones+1)
+    x       = rng.uniform(0, side, nZones)
+    y       = rng.uniform(0, side, nZones)
+    gemeenten = np.array([f'Gemeente{i // ZONES_PER_GEM + 1}' for i in range(nZones)])
+    zez     = (rng.random(nZones) < 0.1).astype(int)
+    uccZone = rng.choice(areanr, nZones)
+
+    with shp.Writer(os.path.join(folder, 'Zones'), shapeType=shp.POINT) as w:
+        w.field('AREANR', 'N', 10, 0)
+        w.field('X', 'N', 12, 2)
+        w.field('Y', 'N', 12, 2)
+        w.field('GEMEENTEN', 'C', 40)
+        w.field('ZEZ', 'N', 2, 0)
+        w.field('UCC_zone', 'N', 10, 0)
+        for i in range(nZones):
+            w.point(x[i], y[i])
+            w.record(int(areanr[i]), x[i], y[i], gemeenten[i], int(zez[i]), int(uccZone[i]))
+
+    pd.DataFrame({
+        'zone':                areanr,
+        'naam':                gemeenten,
+        '1: woningen':         rng.poisson(150, nZones),
+        '9: arbeidspl_totaal': rng.poisson(100, nZones)}).to_csv(os.path.join(folder, 'SEGS.csv'), index=False)
+
+    # External zones around the study area
+    angle = np.linspace(0, 2*np.pi, N_EXTERNAL, endpoint=False)
+    supX  = side/2 + side * np.cos(angle)
+    supY  = side/2 + side * np.sin(angle)
+    pd.DataFrame({
+        'COROP':  np.arange(1, N_EXTERNAL+1),
+        'Xcoor':  supX,
+        'Ycoor':  supY,
+        'AREANR': 99999900 + np.arange(1, N_EXTERNAL+1)}).to_csv(os.path.join(folder, 'SupCoordinatesID.csv'), index=False)
+
+    # Depots in random zones, spread over the couriers
+    cepList    = [f'CEP{c+1}' for c in range(nCEP)]
+    depotZones = rng.choice(nZones, nDepots)
+    with shp.Writer(os.path.join(folder, 'ParcelNodes'), shapeType=shp.POINT) as w:
+        w.field('id', 'N', 24, 15)
+        w.field('Name', 'C', 80)
+        w.field('CEP', 'C', 80)
+        w.field('Surface', 'N', 24, 15)
+        w.field('AREANR', 'N', 24, 15)
+        for i, zone in enumerate(depotZones):
+            w.point(x[zone], y[zone])
+            w.record(i+1, f'Depot {i+1}', cepList[i % nCEP], 5000.0, int(areanr[zone]))
+
+    shares = np.full(nCEP, 1 / nCEP)
+    pd.DataFrame({'CEP': cepList, 'ShareNL': shares, 'ShareForeign': shares, 'ShareTotal': shares}).to_csv(
+        os.path.join(folder, 'CEPshares.csv'), index=False)
+
+    # Inputs of the UCC scenario
+    pd.DataFrame({'Segment': range(8), 'Potential': np.linspace(0.2, 0.9, 8)}).to_csv(
+        os.path.join(folder, 'ConsolidationPotential.csv'), index=False)
+    sharesUCC = pd.DataFrame(rng.random((8, 36)), columns=[f'c{i}' for i in range(36)])
+    sharesUCC.insert(0, 'Segment', range(8))
+    sharesUCC.to_csv(os.path.join(folder, 'ZEZscenario.csv'), index=False)
+
+    # Skims: straight-line distances [m] with some detour and travel times [s] at 40 km/h
+    allX = np.concatenate([x, supX])
+    allY = np.concatenate([y, supY])
+    nSkim = len(allX)
+    for name, factor in [('skimTijd.mtx', 1.3 * 3.6 / 40), ('skimAfstand.mtx', 1.3)]:
+        path = os.path.join(folder, name)
+        with open(path, 'wb') as f:
+            np.array([nSkim], dtype=np.int32).tofile(f)
+            f.truncate(4 + 4 * nSkim**2)
+        skim = np.memmap(path, dtype=np.int32, mode='r+', offset=4, shape=(nSkim, nSkim))
+        for start in range(0, nSkim, chunkSize):
+            rows = slice(start, start + chunkSize)
+            dist = np.hypot(allX[rows, None] - allX[None, :], allY[rows, None] - allY[None, :])
+            skim[rows] = np.round(dist * factor * rng.uniform(1.0, 1.2, dist.shape)).astype(np.int32)
+        skim.flush()
+        del skim
+
+    paths = {
+        'SKIMTIME':      os.path.join(folder, 'skimTijd.mtx'),
+        'SKIMDISTANCE':  os.path.join(folder, 'skimAfstand.mtx'),
+        'ZONES':         os.path.join(folder, 'Zones.shp'),
+        'SEGS':          os.path.join(folder, 'SEGS.csv'),
+        'PARCELNODES':   os.path.join(folder, 'ParcelNodes.shp'),
+        'CEP_SHARES':    os.path.join(folder, 'CEPshares.csv'),
+        'ExternalZones': os.path.join(folder, 'SupCoordinatesID.csv')}
+    return paths, sorted(set(gemeenten))
+
+
+def git_commit():
+    ''' The current git commit of this repo, or None if it is not available '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_model(varDict, seed=1):
+    '''
+    Run the model once on the inputs of varDict and return its result (see
+    generate_parcels). run_scale calls this in a fresh process.
+    '''
+    from Parcel_Generation import ModelInputs, generate_parcels
+
+    np.random.seed(seed)
+    return generate_parcels(varDict, inputs=ModelInputs(varDict))
+
+
+def run_scale(workFolder, nZones, nDepots, nCEP, label='REF', params=None, seed=1):
+    '''
+    Make the inputs for one scale and run the model on them in a new process
+    (spawned, so that it does not inherit the memory of this one). Returns the
+    benchmark record (scale, timings of making the inputs and of each stage).
+    '''
+    scaleFolder = os.path.join(workFolder, f'{nZones}_{nDepots}_{nCEP}')
+    inputFolder = os.path.join(scaleFolder, 'Input') + '/'
+    outputFolder = os.path.join(scaleFolder, 'Output') + '/'
+    os.makedirs(outputFolder, exist_ok=True)
+
+    start = time.perf_counter()
+    paths, gemeenten = make_inputs(inputFolder, nZones, nDepots, nCEP, seed=seed)
+    makeTime = time.perf_counter() - start
+
+    varDict = {
+        'LABEL':               label,
+        'INPUTFOLDER':         inputFolder,
+        'OUTPUTFOLDER':        outputFolder,
+        'Gemeenten_studyarea': gemeenten,
+        'PARCELS_PER_HH':      0.195 + 20.8 / 250 / 8.0,
+        'PARCELS_PER_EMPL':    0.073,
+        'PARCELS_SUCCESS_B2C': 0.75,
+        'PARCELS_SUCCESS_B2B': 0.95,
+        'printKPI':            False,
+        'PROFILE':             True}
+    varDict.update(paths)
+    varDict.update(params or {})
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        result = pool.submit(run_model, varDict, seed).result()
+
+    return {
+        'commit':   git_commit(),
+        'date':     datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':   platform.python_version(),
+        'numpy':    np.__version__,
+        'pandas':   pd.__version__,
+        'label':    label,
+        'params':   params or {},
+        'scale':    {'zones': nZones, 'depots': nDepots, 'ceps': nCEP},
+        'make_inputs_s': round(makeTime, 2),
+        'parcels':  result['KPIs'].get('Number Of Parcels'),
+        'profile':  result['profile']}
+
+
+def print_record(record, previous=None):
+    '''
+    Print the stage timings of a benchmark record, with the change relative to
+    a previous record of the same scale if given
+    '''
+    scale = record['scale']
+    print(f"\n{scale['zones']} zones, {scale['depots']} depots, {scale['ceps']} couriers "
+          f"({record['parcels']} parcels, commit {record['commit']})")
+    if previous is not None:
+        print(f"compared to commit {previous['commit']} of {previous['date']}")
+    stages = dict(record['profile']['stages'], total=record['profile']['total'])
+    for name, stage in stages.items():
+        line = f"  {name:<18} {stage['wall_s']:>9.3f} s wall {stage['cpu_s']:>9.3f} s cpu {stage['peak_rss_mb'] or 0:>9.1f} MB"
+        if previous is not None:
+            before = dict(previous['profile']['stages'], total=previous['profile']['total']).get(name)
+            if before is not None and before['wall_s'] > 0:
+                line += f" {100 * (stage['wall_s'] / before['wall_s'] - 1):>+7.1f}%"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the parcel generator on synthetic inputs.')
+    parser.add_argument('--scale', nargs=3, type=int, action='append', metavar=('ZONES', 'DEPOTS', 'CEPS'),
+                        help='Number of zones, depots and couriers (repeatable; default: %s)' % DEFAULT_SCALES)
+    parser.add_argument('--label', default='REF', help='Scenario label, e.g. UCC')
+    parser.add_argument('--param', nargs=2, action='append', default=[], metavar=('KEY', 'VALUE'),
+                        help='Extra model parameter, VALUE as a Python literal (repeatable)')
+    parser.add_argument('--workfolder', default=None, help='Folder for the synthetic inputs and outputs (default: temporary)')
+    parser.add_argument('--results', default='benchmark_results.jsonl', help='JSON lines file the results are appended to')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    import ast
+    params = {key: ast.literal_eval(value) for key, value in args.param}
+
+    previousRecords = []
+    if os.path.exists(args.results):
+        with open(args.results) as f:
+            previousRecords = [json.loads(line) for line in f if line.strip()]
+
+    with tempfile.TemporaryDirectory() as tempFolder:
+        workFolder = args.workfolder or tempFolder
+        for nZones, nDepots, nCEP in args.scale or DEFAULT_SCALES:
+            record = run_scale(workFolder, nZones, nDepots, nCEP, label=args.label, params=params, seed=args.seed)
+            with open(args.results, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+            # The last earlier run of the same benchmark
+            previous = [r for r in previousRecords
+                        if r['scale'] == record['scale'] and r['label'] == record['label'] and r['params'] == record['params']]
+            print_record(record, previous[-1] if previous else None)
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Convert binary mtx-files (skimTijd and skimAfstand) to the tiled, compressed
+skim format (see write_tiled_mtx in __functions__), or back with --raw.
+The model reads both formats. For example:
+
+    python convert_skim.py Input/skimTijd_new_REF.mtx Input/skimTijd_new_REF_tiled.mtx --scale 1
+"""
+
+import argparse
+import os
+
+from __functions__ import open_mtx, write_mtx, write_tiled_mtx
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert a skim to or from the tiled, compressed format.')
+    parser.add_argument('source', help='mtx-file to convert (raw or tiled)')
+    parser.add_argument('target', help='mtx-file to write')
+    parser.add_argument('--tile-rows', type=int, default=256, help='Number of rows per tile (default: 256)')
+    parser.add_argument('--scale', type=float, default=None,
+                        help='Quantize the values to uint16 multiples of SCALE (lossy; default: lossless int32)')
+    parser.add_argument('--level', type=int, default=6, help='zlib compression level (default: 6)')
+    parser.add_argument('--raw', action='store_true', help='Write a raw mtx-file instead')
+    args = parser.parse_args(argv)
+
+    skim = open_mtx(args.source)
+    if args.raw:
+        write_mtx(args.target, skim)
+    else:
+        write_tiled_mtx(args.target, skim, tileRows=args.tile_rows, scale=args.scale, level=args.level)
+    print(f"{args.source} ({os.path.getsize(args.source) / 1024**2:.1f} MB) --> "
+          f"{args.target} ({os.path.getsize(args.target) / 1024**2:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
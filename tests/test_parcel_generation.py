@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""
+Regression test of the parcel demand model on a small synthetic study area
+
+tests/data/Input holds 300 zones in three municipalities (two in the study
+area), 5 external zones, five depots of two couriers and the skims of these
+305 zones. The files in tests/data/expected were written by the original
+per-zone loop of the model (baseline commit), with np.random.seed(42) before
+the run; its patch of skim zone 6483 was skipped, as the test skims are
+smaller.
+"""
+
+import filecmp
+import gzip
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from Parcel_Generation import ModelInputs, generate_parcels, read_params
+
+INPUT    = os.path.join(REPO, 'tests', 'data', 'Input') + '/'
+EXPECTED = os.path.join(REPO, 'tests', 'data', 'expected')
+
+
+def make_varDict(label, outputFolder, **params):
+    ''' The varDict of a run on the test inputs, as generate_args builds it from the command line '''
+    varDict = {
+        'LABEL':         label,
+        'INPUTFOLDER':   INPUT,
+        'OUTPUTFOLDER':  str(outputFolder) + '/',
+        'SKIMTIME':      INPUT + 'skimTijd.mtx',
+        'SKIMDISTANCE':  INPUT + 'skimAfstand.mtx',
+        'ZONES':         INPUT + 'Zones.shp',
+        'SEGS':          INPUT + 'SEGS.csv',
+        'PARCELNODES':   INPUT + 'ParcelNodes.shp',
+        'CEP_SHARES':    INPUT + 'CEPshares.csv',
+        'ExternalZones': INPUT + 'SupCoordinatesID.csv'}
+    with open(INPUT + 'Params.txt') as params_file:
+        read_params(params_file, varDict)
+    varDict.update(params)
+    return varDict
+
+
+def run(label, outputFolder, **params):
+    os.makedirs(outputFolder, exist_ok=True)
+    varDict = make_varDict(label, outputFolder, **params)
+    np.random.seed(42)
+    return generate_parcels(varDict, inputs=ModelInputs(varDict))
+
+
+def assert_same_file(outputFolder, fileName):
+    assert filecmp.cmp(os.path.join(outputFolder, fileName), os.path.join(EXPECTED, fileName), shallow=False), \
+        f"{fileName} differs from the expected output"
+
+
+def test_ref_matches_baseline(tmp_path):
+    run('REF', tmp_path)
+    assert_same_file(tmp_path, 'ParcelDemand_REF.csv')
+
+
+def test_ucc_matches_baseline(tmp_path):
+    run('UCC', tmp_path)
+    assert_same_file(tmp_path, 'ParcelDemand_REF.csv')
+    assert_same_file(tmp_path, 'ParcelDemand_UCC.csv')
+
+
+@pytest.mark.parametrize('params', [{'BATCH_SIZE': 1000}, {'WORKERS': 2}, {'SKIM_STUDYAREA': True}])
+def test_options_match_baseline(tmp_path, params):
+    run('REF', tmp_path, **params)
+    assert_same_file(tmp_path, 'ParcelDemand_REF.csv')
+
+
+def test_capacitated_without_parcels(tmp_path):
+    run('REF', tmp_path, DEPOT_CAPACITY=10, PARCELS_PER_HH=0, PARCELS_PER_EMPL=0)
+    with open(os.path.join(tmp_path, 'ParcelDemand_REF.csv')) as f:
+        assert f.read().splitlines() == ['Parcel_ID,O_zone,D_zone,DepotNumber,CEP,VEHTYPE']
+
+
+def test_capacitated_assignment():
+    from Parcel_Generation import assign_depots_capacitated, build_parcel_counts
+    inputs      = ModelInputs(make_varDict('REF', INPUT))
+    zones       = inputs.zones
+    skimNrs     = inputs.zoneIndex.skim_numbers(zones['AREANR'])
+    nParcelsCep = np.random.default_rng(1).integers(0, 20, (len(zones), len(inputs.cepList)))
+    depotZones  = inputs.parcelNodes['AREANR']
+    depotCeps   = np.asarray(inputs.parcelNodes['CEP'])
+    candidates, candidateTimes = [values[skimNrs-1] for values in inputs.depotCandidates]
+    
+    # Too little capacity for CEPA, just enough in total for CEPB but not at its nearest depots
+    demand   = dict(zip(inputs.cepList, nParcelsCep.sum(axis=0)))
+    capacity = np.array([0.8 * demand['CEPA'] / 3 if cep == 'CEPA' else 0.55 * demand['CEPB'] for cep in depotCeps]).round()
+    parcelCounts, overflow = assign_depots_capacitated(zones['AREANR'], nParcelsCep, candidates, candidateTimes,
+                                                       capacity, depotZones, inputs.cepList)
+    
+    # All parcels are assigned, to depots of their courier
+    perZone = parcelCounts.groupby(['D_zone', 'CEP'])['Parcels'].sum().unstack(fill_value=0)
+    assert np.array_equal(perZone.reindex(index=zones['AREANR'], columns=inputs.cepList, fill_value=0), nParcelsCep)
+    assert np.all(depotCeps[parcelCounts['DepotNumber'] - 1] == parcelCounts['CEP'])
+    
+    # Depots are only over capacity when all depots of the courier (all candidates here) are full
+    load = np.bincount(parcelCounts['DepotNumber'] - 1, weights=parcelCounts['Parcels'], minlength=len(capacity))
+    assert np.array_equal(overflow, np.maximum(load - capacity, 0))
+    for cep in inputs.cepList:
+        depots = (depotCeps == cep)
+        assert not (np.any(load[depots] > capacity[depots]) and np.any(load[depots] < capacity[depots]))
+    assert overflow[depotCeps == 'CEPA'].sum() > 0 and overflow[depotCeps == 'CEPB'].sum() == 0
+    nearestLoad = np.bincount(candidates[:,:,0].ravel(), weights=nParcelsCep.ravel(), minlength=len(capacity))
+    assert np.any((nearestLoad > capacity) & (depotCeps == 'CEPB'))
+    
+    # With unbounded capacity, every zone gets its nearest depot
+    unbounded, overflow = assign_depots_capacitated(zones['AREANR'], nParcelsCep, candidates, candidateTimes,
+                                                    np.full(len(capacity), np.inf), depotZones, inputs.cepList)
+    nearest = build_parcel_counts(zones['AREANR'], nParcelsCep, inputs.depotChoice[skimNrs-1], depotZones, inputs.cepList)
+    assert not overflow.any()
+    assert unbounded.reset_index(drop=True).equals(nearest.reset_index(drop=True))
+
+
+def test_batches_without_parcels(tmp_path):
+    run('REF', tmp_path, BATCH_SIZE=1000, PARCELS_PER_HH=0, PARCELS_PER_EMPL=0)
+    with open(os.path.join(tmp_path, 'ParcelDemand_REF.csv')) as f:
+        assert f.read().splitlines() == ['Parcel_ID,O_zone,D_zone,DepotNumber,CEP,VEHTYPE']
+
+
+def test_batches_compressed(tmp_path):
+    run('REF', tmp_path, BATCH_SIZE=1000, OUTPUT_COMPRESSION='gzip')
+    with gzip.open(os.path.join(tmp_path, 'ParcelDemand_REF.csv'), 'rb') as f, \
+         open(os.path.join(EXPECTED, 'ParcelDemand_REF.csv'), 'rb') as expected:
+        assert f.read() == expected.read()
+
+
+@pytest.mark.parametrize('label', ['REF', 'UCC'])
+def test_geojson(tmp_path, label):
+    import json
+    result = run(label, tmp_path / 'plain', WRITE_GEOJSON=True)
+    run(label, tmp_path / 'gzip', WRITE_GEOJSON=True, GEOJSON_GZIP=True)
+    with open(tmp_path / 'plain' / f'ParcelDemand_{label}.geojson', encoding='utf-8') as f:
+        geojson = json.load(f)
+    with gzip.open(tmp_path / 'gzip' / f'ParcelDemand_{label}.geojson.gz', 'rt', encoding='utf-8') as f:
+        assert json.load(f) == geojson
+    
+    # Lines from the depot or UCC to the destination zone, with all parcels
+    features = geojson['features']
+    assert geojson['type'] == 'FeatureCollection' and features
+    assert sum(feature['properties']['Parcels'] for feature in features) == result['KPIs']['Number Of Parcels']
+    zoneIndex = ModelInputs(make_varDict(label, tmp_path)).zoneIndex
+    destX, destY = zoneIndex.coordinates([feature['properties']['D_zone'] for feature in features])
+    assert np.allclose([feature['geometry']['coordinates'][1] for feature in features], np.column_stack([destX, destY]))
+
+
+def test_columnar_batches_without_parcels(tmp_path):
+    pytest.importorskip('pyarrow')
+    from __functions__ import read_columnar
+    run('REF', tmp_path, BATCH_SIZE=1000, OUTPUT_FORMAT='parquet', PARCELS_PER_HH=0, PARCELS_PER_EMPL=0)
+    parcels = read_columnar(os.path.join(tmp_path, 'ParcelDemand_REF.parquet'))
+    assert len(parcels) == 0
+    assert list(parcels.columns) == ['Parcel_ID', 'O_zone', 'D_zone', 'DepotNumber', 'CEP', 'VEHTYPE']
+
+
+@pytest.mark.parametrize('fileFormat', ['parquet', 'feather'])
+@pytest.mark.parametrize('batchSize', [None, 1000])
+def test_columnar_output(tmp_path, fileFormat, batchSize):
+    pa = pytest.importorskip('pyarrow')
+    import pandas as pd
+    from __functions__ import read_columnar
+    run('REF', tmp_path, OUTPUT_FORMAT=fileFormat, BATCH_SIZE=batchSize)
+    path = os.path.join(tmp_path, f'ParcelDemand_REF.{fileFormat}')
+    
+    # IDs as int32 and the courier as a category, with the values of the CSV output
+    schema = read_columnar(path, asTable=True).schema
+    for col in ['Parcel_ID', 'O_zone', 'D_zone', 'DepotNumber', 'VEHTYPE']:
+        assert schema.field(col).type == pa.int32()
+    assert pa.types.is_dictionary(schema.field('CEP').type)
+    parcels  = read_columnar(path)
+    expected = pd.read_csv(os.path.join(EXPECTED, 'ParcelDemand_REF.csv'))
+    assert isinstance(parcels['CEP'].dtype, pd.CategoricalDtype)
+    assert len(parcels) == len(expected) > 0
+    pd.testing.assert_frame_equal(parcels.astype({'CEP': str}), expected, check_dtype=False)
+
+
+def test_parcel_kpis(tmp_path):
+    import pandas as pd
+    from __functions__ import open_mtx
+    KPIs = run('UCC', tmp_path)['KPIs']
+    
+    # Parcel-km of each parcel leg, straight from the skim, with 0.7 times the nearest zone within a zone
+    parcels = pd.read_csv(os.path.join(EXPECTED, 'ParcelDemand_UCC.csv'))
+    inputs  = ModelInputs(make_varDict('UCC', tmp_path))
+    skim    = np.array(open_mtx(INPUT + 'skimAfstand.mtx'), dtype=float)
+    origs   = inputs.zoneIndex.skim_numbers(parcels['O_zone']) - 1
+    dests   = inputs.zoneIndex.skim_numbers(parcels['D_zone']) - 1
+    intrazonal = 0.7 * np.where(skim > 0, skim, np.inf).min(axis=1)
+    parcels['km'] = np.where(origs == dests, intrazonal[origs], skim[origs, dests]) / 1000
+    assert np.any(origs == dests)
+    
+    def grouped(by):
+        return {str(name): {'Parcels': len(group), 'Parcel Km': pytest.approx(group['km'].sum(), abs=1e-3)}
+                for name, group in parcels.groupby(by)}
+    
+    municipality = inputs.zones['GEMEENTEN'].reindex(parcels['D_zone']).fillna('Unknown')
+    assert KPIs['Parcel Km'] == pytest.approx(parcels['km'].sum(), abs=1e-3)
+    assert KPIs['Per CEP'] == grouped('CEP')
+    assert KPIs['Per Depot'] == grouped('DepotNumber')
+    assert KPIs['Per Municipality'] == grouped(np.asarray(municipality))
+    assert KPIs['Per Vehicle Type'] == grouped('VEHTYPE')
+    assert KPIs['UCC']['Parcels Via UCC'] == parcels['FROM_UCC'].sum()
+    assert KPIs['UCC']['Parcel Km To UCC'] == pytest.approx(parcels['km'][parcels['TO_UCC'] == 1].sum(), abs=1e-3)
+    assert KPIs['UCC']['Parcel Km From UCC'] == pytest.approx(parcels['km'][parcels['FROM_UCC'] == 1].sum(), abs=1e-3)
+
+
+def test_batch_log_per_scenario(tmp_path):
+    from Parcel_Generation import run_batch
+    batchFile = tmp_path / 'batch.json'
+    batchFile.write_text('[{"LABEL": "A"}, {"LABEL": "B"}, {"LABEL": "C"}]')
+    varDict = make_varDict('REF', tmp_path)
+    returnInfo = run_batch(varDict, str(batchFile), ModelInputs(varDict), workers=3)
+    assert [info[0] for info in returnInfo] == [0, 0, 0]
+    for label in 'ABC':
+        with open(os.path.join(tmp_path, f'Logfile_ParcelDemand_{label}.log')) as f:
+            assert f'ParcelDemand_{label}.csv' in f.read()
+
+
+def test_intrazonal_skim(tmp_path):
+    import shutil
+    from __functions__ import InputCache, open_mtx, read_mtx_intrazonal
+    skimFile = INPUT + 'skimAfstand.mtx'
+    skim     = np.array(open_mtx(skimFile))
+    rowMin   = np.where(skim > 0, skim, np.iinfo(np.int32).max).min(axis=1)
+    cache    = InputCache(str(tmp_path / 'cache'))
+    
+    inMemory = read_mtx_intrazonal(skimFile)
+    cached   = read_mtx_intrazonal(skimFile, cache=cache)
+    assert np.array_equal(np.diagonal(inMemory), (0.7 * rowMin).astype(np.int32))
+    assert np.array_equal(inMemory, cached)
+    assert np.array_equal(open_mtx(skimFile), skim)
+    assert not [file for file in os.listdir(INPUT) if 'intrazonal' in file]
+    
+    # Other settings are cached separately
+    patched = read_mtx_intrazonal(skimFile, deficientZones=[3], cache=cache)
+    assert np.all(np.delete(patched[3, :], 3) == 5000) and not np.all(np.delete(cached[3, :], 3) == 5000)
+    assert len([file for file in os.listdir(cache.cacheFolder) if file.endswith('.mtx')]) == 2
+    with pytest.raises(ValueError):
+        read_mtx_intrazonal(skimFile, deficientZones=[6483])
+    
+    # A changed skim is not served from the cache, even with an older modification time (cp -p)
+    copyFile = str(tmp_path / 'skim.mtx')
+    shutil.copyfile(skimFile, copyFile)
+    read_mtx_intrazonal(copyFile, cache=cache)
+    changed = open_mtx(copyFile, mode='r+')
+    changed[:] = 2 * skim
+    changed.flush()
+    del changed
+    os.utime(copyFile, (0, 0))
+    assert np.array_equal(np.delete(read_mtx_intrazonal(copyFile, cache=cache)[0], 0), 2 * np.delete(skim[0], 0))
+    
+    # The mtx-files count towards the size of the cache
+    InputCache(cache.cacheFolder, maxSize=0).evict()
+    assert not [file for file in os.listdir(cache.cacheFolder) if file.endswith('.mtx')]
+
+
+def test_input_cache(tmp_path):
+    import shutil
+    from __functions__ import InputCache, open_mtx
+    cacheFolder = str(tmp_path / 'cache')
+    run('REF', tmp_path / 'first', CACHEFOLDER=cacheFolder)
+    entries = sorted(os.listdir(cacheFolder))
+    assert [file for file in entries if file.startswith('depotChoice_')]
+    
+    # A second run reads the cached inputs and writes the same output
+    run('REF', tmp_path / 'second', CACHEFOLDER=cacheFolder)
+    assert sorted(os.listdir(cacheFolder)) == entries
+    assert_same_file(tmp_path / 'first', 'ParcelDemand_REF.csv')
+    assert_same_file(tmp_path / 'second', 'ParcelDemand_REF.csv')
+    
+    # A changed skim gets new entries: slow down the roads from the first depot
+    inputFolder = str(tmp_path / 'Input') + '/'
+    shutil.copytree(INPUT, inputFolder)
+    params = {key: value.replace(INPUT, inputFolder) for key, value in make_varDict('REF', tmp_path).items()
+              if isinstance(value, str) and value.startswith(INPUT)}
+    skimNr = ModelInputs(make_varDict('REF', tmp_path)).zoneIndex.skim_numbers([128])[0]
+    skim   = open_mtx(params['SKIMTIME'], mode='r+')
+    skim[skimNr-1] *= 10
+    skim.flush()
+    del skim
+    run('REF', tmp_path / 'changed', CACHEFOLDER=cacheFolder, **params)
+    run('REF', tmp_path / 'uncached', **params)
+    assert len([file for file in os.listdir(cacheFolder) if file.startswith('depotChoice_')]) == 2
+    assert filecmp.cmp(tmp_path / 'changed' / 'ParcelDemand_REF.csv', tmp_path / 'uncached' / 'ParcelDemand_REF.csv', shallow=False)
+    assert not filecmp.cmp(tmp_path / 'changed' / 'ParcelDemand_REF.csv', tmp_path / 'first' / 'ParcelDemand_REF.csv', shallow=False)
+    
+    # CACHE_MAXSIZE is in MB, and the least recently used entries are removed beyond it
+    assert ModelInputs(make_varDict('REF', tmp_path, CACHEFOLDER=cacheFolder, CACHE_MAXSIZE=0.5)).cache.maxSize == 0.5 * 1024**2
+    cache = InputCache(str(tmp_path / 'lru'), maxSize=200_000)
+    for name in ['a', 'b', 'a', 'c']:
+        cache.get(name, [params['SEGS']], lambda: np.zeros(10_000))
+        time.sleep(0.02)
+    files = [os.path.join(cache.cacheFolder, file) for file in os.listdir(cache.cacheFolder) if file.endswith('.npz')]
+    assert sorted(os.path.basename(file)[0] for file in files) == ['a', 'c']
+    assert sum(os.path.getsize(file) for file in files) <= cache.maxSize
+
+
+def test_c2c_distribution(tmp_path):
+    params   = {'C2C_DISTRIBUTION': True, 'C2C_SEED': 7, 'C2C_BLOCKSIZE': 50}
+    serial   = run('REF', tmp_path / 'serial', **params)
+    parallel = run('REF', tmp_path / 'parallel', WORKERS=3, **params)
+    assert serial['KPIs']['Number Of C2C Parcels'] > 0
+    assert filecmp.cmp(tmp_path / 'serial' / 'ParcelDemandC2C_REF.csv', tmp_path / 'parallel' / 'ParcelDemandC2C_REF.csv', shallow=False)
+    
+    # The local C2C parcels are not also delivered from the depots
+    varDict = make_varDict('REF', tmp_path)
+    run('REF', tmp_path / 'depots', PARCELS_PER_HH=varDict['PARCELS_PER_HH'] - varDict['PARCELS_PER_HH_C2C'] * varDict['Local2Local'])
+    assert filecmp.cmp(tmp_path / 'serial' / 'ParcelDemand_REF.csv', tmp_path / 'depots' / 'ParcelDemand_REF.csv', shallow=False)
+    assert not filecmp.cmp(tmp_path / 'serial' / 'ParcelDemand_REF.csv', os.path.join(EXPECTED, 'ParcelDemand_REF.csv'), shallow=False)
+
+
+def test_serve_keeps_preloaded_inputs(tmp_path):
+    import json
+    import socket
+    import threading
+    import urllib.error
+    import urllib.request
+    import Parcel_Generation
+    
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    preloaded = []
+    class Inputs(ModelInputs):
+        def preload(self):
+            preloaded.append(self)
+            return super().preload()
+    original, Parcel_Generation.ModelInputs = Parcel_Generation.ModelInputs, Inputs
+    try:
+        threading.Thread(target=Parcel_Generation.serve, args=(make_varDict('REF', tmp_path), port), daemon=True).start()
+        def post(params):
+            request = urllib.request.Request(f'http://127.0.0.1:{port}/generate', data=json.dumps(params).encode())
+            for attempt in range(50):
+                try:
+                    with urllib.request.urlopen(request) as response:
+                        return response.status, json.load(response)
+                except urllib.error.HTTPError as e:
+                    return e.code, json.load(e)
+                except urllib.error.URLError:
+                    time.sleep(0.1)
+        
+        assert post({'LABEL': 'A', 'ZONES': INPUT + 'Missing.shp'})[0] == 500
+        assert post({'LABEL': 'A', 'OUTPUTFOLDER': '/nonexistent/'})[0] == 500
+        status, result = post({'LABEL': 'B'})
+        assert status == 200 and result['KPIs']['Number Of Parcels'] > 0
+    finally:
+        Parcel_Generation.ModelInputs = original
+    assert preloaded[0].varDict['ZONES'] == INPUT + 'Zones.shp'
+    assert 'skimDistance' in preloaded[0].__dict__
+    assert Parcel_Generation._inputs is None
+
+
+def test_failed_run_stops_profilers(tmp_path):
+    import tracemalloc
+    from Parcel_Generation import actually_run_module
+    varDict = make_varDict('REF', tmp_path, PROFILE_TRACEMALLOC=True, PROFILE_CPROFILE=True, ZONES=INPUT + 'Missing.shp')
+    assert actually_run_module(['', varDict, ModelInputs(varDict)])[0] == 1
+    assert not tracemalloc.is_tracing()
+    assert sys.getprofile() is None
+
+
+def test_parallel_parcel_counts():
+    from Parcel_Generation import build_parcel_counts, parallel_parcel_counts
+    inputs      = ModelInputs(make_varDict('REF', INPUT))
+    zones       = inputs.zones
+    skimNrs     = inputs.zoneIndex.skim_numbers(zones['AREANR'])
+    nParcelsCep = np.random.default_rng(1).integers(0, 5, (len(zones), len(inputs.cepList)))
+    depotZones  = inputs.parcelNodes['AREANR']
+    serial   = build_parcel_counts(zones['AREANR'], nParcelsCep, inputs.depotChoice[skimNrs-1], depotZones, inputs.cepList)
+    parallel = parallel_parcel_counts(inputs.parcelSkim, skimNrs, zones['AREANR'], nParcelsCep, depotZones,
+                                      inputs.cepList, inputs.cepNodeDict, workers=3)
+    assert parallel.equals(serial)
+
+
+def test_tiled_skim_indexing(tmp_path):
+    from __functions__ import open_mtx, write_tiled_mtx
+    skim = np.array(open_mtx(INPUT + 'skimTijd.mtx'))
+    write_tiled_mtx(str(tmp_path / 'skim.mtx'), skim, tileRows=64)
+    tiled = open_mtx(str(tmp_path / 'skim.mtx'))
+    
+    mask = np.zeros(len(skim), dtype=bool)
+    mask[[5, 70, 300]] = True
+    rows, cols = np.array([4, 200, 7]), np.array([1, 2, 304])
+    assert np.array_equal(tiled[mask], skim[mask])
+    assert np.array_equal(tiled[10:140:3], skim[10:140:3])
+    assert np.array_equal(tiled[np.ix_(rows, cols)], skim[np.ix_(rows, cols)])
+    assert np.array_equal(tiled[7, cols], skim[7, cols])
+    with pytest.raises(IndexError):
+        tiled[mask[:10]]